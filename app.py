@@ -1,16 +1,14 @@
-import sqlite3
+import time
+started_at = time.perf_counter()  # time to first frame is measured from here
+
+import asyncio
 import threading
-import notify2
-from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import parse_qs
+from collections import OrderedDict
 
 from halo import Halo
 from prompt_toolkit import ANSI
-from prompt_toolkit.application import Application, get_app
+from prompt_toolkit.application import Application
 from prompt_toolkit.buffer import Buffer
-from prompt_toolkit.document import Document
-from prompt_toolkit.filters import Condition
 from prompt_toolkit.formatted_text import to_formatted_text, \
     fragment_list_to_text
 from prompt_toolkit.key_binding import KeyBindings
@@ -20,128 +18,244 @@ from prompt_toolkit.layout.containers import HSplit, VSplit, Window
 from prompt_toolkit.layout.layout import Layout
 from prompt_toolkit.layout.processors import Processor, Transformation
 from prompt_toolkit.styles import Style
-from prompt_toolkit.widgets import SearchToolbar, TextArea, Frame, RadioList
+from prompt_toolkit.widgets import SearchToolbar, TextArea, Frame
 
+import metrics
 import utils
+from capture import Capture
+from highlight import HighlightMatcher
+from history import HistoryStore
+from ingest import EventQueue, Resequencer, SeenSet
+from message import MESSAGE, render
+from notifier import Notifier
+from outbox import Outbox, SENT
+from relay import RelayClient
+from server import chat_server
+from sidebar import ChannelList
+from unread import UnreadCounters
 from utils import ansi_bold, ansi_italics, ansi_end
-
-conn = sqlite3.connect(':memory:', check_same_thread=False)
-c = conn.cursor()
-conn.execute('''CREATE TABLE history
-                    (id integer primary key,
-                    msg_time time, sender text, msg text, channel text)''')
+from view import MessageView
+
+utils.login()
+
+history = HistoryStore(
+    utils.config.get('history', 'path', fallback='.cchat_history.db'),
+    batch_size=utils.config.getint('history', 'batch_size', fallback=100),
+    flush_interval=utils.config.getfloat('history', 'flush_interval',
+                                         fallback=0.5),
+    on_error=lambda e: run_in_ui(view.append, f"{e}"),
+    keep_messages=utils.config.getint('history', 'keep_messages',
+                                      fallback=5000),
+    keep_days=utils.config.getint('history', 'keep_days', fallback=30),
+    archive_interval=utils.config.getfloat('history', 'archive_interval',
+                                           fallback=3600),
+)
 
 identity = utils.config['user']['identity']
+# the username and any [highlight] keywords, compiled once
+highlights = HighlightMatcher(
+    [f'@{identity}'] +
+    utils.config.get('highlight', 'keywords', fallback='').split(','))
 
 spinner = Halo(spinner="dots", text="starting app ...")
 spinner.start()
 
-notify2.init("cchat")
-n = notify2.Notification(None)
-n.set_urgency(notify2.URGENCY_NORMAL)
-n.set_timeout(5000)
+notifier = Notifier(
+    window=utils.config.getfloat('notifications', 'window', fallback=2),
+    min_interval=utils.config.getfloat('notifications', 'min_interval',
+                                       fallback=5),
+)
 
 cmd_area_text = "type in command/message - ctrl-c to quit"
 
+ingest_latency = metrics.histogram(
+    'cchat_ingest_to_display_seconds',
+    'Time from a webhook arriving to the message being handled by the ui')
+render_time = metrics.histogram('cchat_render_seconds',
+                                'Time spent redrawing the interface')
+frame_batch_sizes = metrics.histogram('cchat_frame_batch_size',
+                                     'Webhook events handled per frame',
+                                     buckets=metrics.SIZE_BUCKETS)
+
+max_fps = utils.config.getfloat('ui', 'max_fps', fallback=20)
+
+# parsed webhook events waiting to be shown by the ui thread
+events = EventQueue(
+    maxsize=utils.config.getint('server', 'queue_size', fallback=1000),
+    policy=utils.config.get('server', 'backpressure', fallback='block'),
+)
 
-class ChatServer(BaseHTTPRequestHandler, ):
-    def _set_headers(self):
-        self.send_response(200)
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
-
-    def _html(self, params):
-        """Shows the url params on the browser in html.
-            Nothing useful. Just for debugging
-            """
-        content = f"<html><body><p>{params}</p></body></html>"
-        return content.encode("utf8")
-
-    def do_GET(self):
-        self._set_headers()
-        buffer = Application.current_buffer
-        params = parse_qs(self.path)
-        self.wfile.write(self._html(params))
-        channel = params.get('/?ChannelSid') or params.get('ChannelSid')
-        if channel:
-            channel = channel[0]
-        chat_handler(buffer, process_response(params), channel=channel)
-
-    def log_message(self, format, *args):
-        """suppress logs"""
-        return
+# webhooks twilio retried are dropped by message sid, and each channel's
+# messages are put back in index order before they are shown
+seen_size = utils.config.getint('server', 'dedupe_size', fallback=10000)
+seen = SeenSet(seen_size, history.recent_sids(seen_size))
+resequencer = Resequencer(
+    window=utils.config.getfloat('server', 'reorder_window', fallback=1.0),
+    next_index=history.next_indexes(),
+)
+
+# connections waiting to be accepted by the webhook server
+backlog = utils.config.getint('server', 'backlog', fallback=128)
+
+# raw webhook requests recorded for bench.replay
+capture_path = utils.config.get('server', 'capture', fallback=None)
+capture = Capture(capture_path) if capture_path else None
+
+# with a relay hub the events come from it instead of our own webhook server
+relay_address = utils.config.get('server', 'relay', fallback=None)
+relay = RelayClient(
+    relay_address, events,
+    on_error=lambda text: run_in_ui(view.append, text),
+) if relay_address else None
+
+
+ui_loop = None
+
+
+def run_in_ui(func, *args):
+    """call func on the ui thread, safe to use from worker threads"""
+    if ui_loop is None:
+        func(*args)
+    else:
+        ui_loop.call_soon_threadsafe(func, *args)
+
+
+def start_ui():
+    global ui_loop
+    ui_loop = asyncio.get_event_loop()
+    application.create_background_task(consume_events())
+    application.before_render += start_render_timer
+    application.after_render += stop_render_timer
+    application.after_render += report_first_frame
+    show_history(channel_list.current)  # what #general had last time
+    threading.Thread(name='load_channels', target=load_channels,
+                     daemon=True).start()
+
+
+render_started_at = None
+
+
+def start_render_timer(app):
+    global render_started_at
+    render_started_at = time.perf_counter()
+
+
+def stop_render_timer(app):
+    if render_started_at is not None:
+        render_time.observe(time.perf_counter() - render_started_at)
 
 
-def chat_server(server_class=HTTPServer,
-                handler_class=ChatServer,
-                addr="localhost",
-                port=8000):
-    server_address = (addr, port)
-    httpd = server_class(server_address, handler_class)
-    httpd.serve_forever()
+first_frame_at = None
 
 
-def process_response(response, from_db=False):
-    """receives response from webhook when actions happen on the chat client
-    processes response and returns a formatted message to show on the client
-    response might also be from db in the case of fetching chat history"""
+def report_first_frame(app):
+    global first_frame_at
+    if first_frame_at is None:
+        first_frame_at = time.perf_counter()
+        view.append(f"{ansi_italics}ready in "
+                    f"{first_frame_at - started_at:.2f}s{ansi_end}")
+
+
+def load_channels():
+    """fetch the channel list off the ui thread"""
     try:
-        if from_db:
-            processed_response = ''
-            for line in response:
-                message_time = line[1]
-                message_from = line[2]
-                message_body = line[3]
-                processed_response += f"{message_time} " \
-                                      f"{message_from}  " \
-                                      f"{message_body}"
-        else:
-            if response.get('/?EventType') and response['/?EventType'][0] in (
-                    'onMemberAdded', 'onMemberRemoved',):
-                processed_response = f"{ansi_italics}{response['Identity'][0]} " \
-                                     f"{response['Reason'][0].lower()}{ansi_end}\n"
-            else:
-                message_date = datetime.strptime(
-                    response['DateCreated'][0], '%Y-%m-%dT%H:%M:%S.%fZ'
-                )
-                message_time = message_date.strftime("%H:%M")
-                message_from = response['From'][0]
-                message_body = response['Body'][0]
-                processed_response = f"{message_time} " \
-                                     f"{ansi_bold}{message_from}{ansi_end}  " \
-                                     f"{message_body}\n"
-        return f"{processed_response}"
-    except KeyError as e:
-        return f"Failed to parse response: {e}\n"
+        channels = utils.get_channels()
     except Exception as e:
-        return f"An error occurred: {e}"
+        run_in_ui(view.append, f"failed to load channels: {e}")
+    else:
+        run_in_ui(set_channels, channels)
+        if utils.config.getboolean('backfill', 'enabled', fallback=True):
+            run_in_ui(view.append, utils.backfill(
+                history, report=lambda text: run_in_ui(view.append, text),
+                on_messages=lambda *args: run_in_ui(show_backfilled, *args)))
+
+
+def set_channels(channels):
+    """list (sid, name) channels, only what changed is updated"""
+    channel_list.update(channels)
+    if relay is not None:
+        relay.subscribe(channel_list.names)
+
+
+def channel_label(sid):
+    """a channel's name with its unread count, made when its row is drawn"""
+    name = channel_list.names[sid]
+    count = unread.count(sid)
+    if count:
+        return ANSI(f"{ansi_bold}{name}{ansi_end} ({count})")
+    return name
+
+
+async def consume_events():
+    """apply queued webhook events on the ui thread, one frame at a time.
+    Everything that arrived since the last frame is handled as one batch
+    and drawn once, so bursts of messages cost at most max_fps redraws
+    a second."""
+    interval = 1 / max_fps
+    loop = asyncio.get_event_loop()
+    while True:
+        started = loop.time()
+        batch = resequencer.release(events.drain())
+        for message in batch:
+            chat_handler(None, message)
+        if view.flush() or batch:
+            # batch may only have changed the unread counts
+            application.invalidate()
+        frame_batch_sizes.observe(len(batch))
+        await asyncio.sleep(max(0.0, interval - (loop.time() - started)))
 
 
 spinner.start("rendering interface ...")
 
 
 class FormatText(Processor):
+    """Renders the ansi escape sequences in the output pane.
+    Parsed fragments are kept in an lru cache keyed on the line text,
+    so a render only parses lines that are new or have changed."""
+
+    def __init__(self, cache_size=2000):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
     def apply_transformation(self, input_):
-        fragments = to_formatted_text(
-            ANSI(fragment_list_to_text(input_.fragments)))
+        line = fragment_list_to_text(input_.fragments)
+        fragments = self._cache.get(line)
+        if fragments is None:
+            fragments = to_formatted_text(ANSI(line))
+            self._cache[line] = fragments
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(line)
         return Transformation(fragments)
 
 
 # layout.
 search_field = SearchToolbar()  # for reverse search.
 output_field = Buffer()
-channels_window = RadioList(utils.get_channels())
+unread = UnreadCounters(history)
+if utils.config.has_option('channels', 'general'):
+    # only #general to begin with, the full list is loaded in the
+    # background once the interface is up
+    initial_channels = [(utils.config['channels']['general'], 'general')]
+else:
+    initial_channels = utils.get_channels()
 general_ch = utils.config['channels']['general']
-channels_window.current_value = general_ch
-channels_frame = Frame(channels_window, title="channels",
+channel_list = ChannelList(initial_channels, pinned=general_ch,
+                           label=channel_label,
+                           on_select=lambda sid: switch_channel(sid))
+unread.mark_read(general_ch)
+channels_window = Window(channel_list)
+channels_frame = Frame(channels_window, title=lambda: channel_list.title,
                        width=23)
 
-output_window = Frame(Window(BufferControl(
+messages_window = Window(BufferControl(
     buffer=output_field,
     focusable=False,
-    input_processors=[FormatText()]),
-    wrap_lines=True),
-    title="#general")
+    input_processors=[FormatText(
+        utils.config.getint('ui', 'format_cache', fallback=2000))]),
+    wrap_lines=True)
+output_window = Frame(messages_window, title="#general")
 input_field = TextArea(
     height=1,
     prompt='> ',
@@ -161,49 +275,85 @@ container = HSplit(
 )
 
 
-def chat_handler(buffer, message, channel=None, from_db=False):
-    """from_db=True if showing chat history"""
+def load_history(before_id, limit):
+    """page of the active channel's history for the message view,
+    newest page if before_id is None"""
+    messages = history.page(channel_list.current, before_id, limit)
+    return [(message.id, render(message, highlights.highlight))
+            for message in messages]
+
+
+view = MessageView(
+    output_field,
+    scrollback=utils.config.getint('ui', 'scrollback', fallback=1000),
+    page_size=utils.config.getint('ui', 'page_size', fallback=50),
+    loader=load_history,
+    deferred=True,  # drawn by consume_events once per frame
+)
+
+
+def chat_handler(buffer, message):
+    """save an incoming message and show it if its channel is active"""
+    active_channel_sid = channel_list.current
+    if message.event == MESSAGE:
+        save_message(message)
+        unread.add(message, read=message.channel == active_channel_sid)
     try:
-        active_channel_sid = channels_window.current_value
-        if channel == active_channel_sid:  # only show the message if the channel it was sent to is the active one
-            output = output_field.text + message
-            output_field.document = Document(
-                text=output, cursor_position=len(output),
-            )
+        if message.channel == active_channel_sid:  # only show the message if the channel it was sent to is the active one
+            view.append(render(message, highlights.highlight), message.id)
     except BaseException as e:
-        output = output_field.text + "{}\n".format(e)
-        output_field.document = Document(
-            text=output, cursor_position=len(output),
-        )
+        view.append(f"{e}")
+    if message.received is not None:
+        ingest_latency.observe(time.perf_counter() - message.received)
+
+
+def save_message(message):
+    """When a user switches channels, we want to clear the messages
+    in the current channel and show the messages from the new channel.
+    When they come back to a previous channel, they expect to see the
+    messages they left there (+new unread ones if any). Fetching all
+    channel messages from the server each time would be expensive,
+    so save chat in sqlite db and fetch from there."""
+    try:
+        history.add(message)
+        # show notification if user is @mentioned or a highlight word is used
+        if highlights.matches(message.body):
+            mentioned_channel = utils.channel_directory.name(message.channel) \
+                or message.channel
+            notifier.mention(mentioned_channel)
+    except Exception as e:
+        view.append(f"{e}")
+
+
+def show_history(channel):
+    """replace the output pane with the channel's latest messages.
+    Only one screenful is loaded so switching channels takes the same
+    time however long the history is, older pages are loaded by the
+    view when scrolling back."""
+    info = messages_window.render_info
+    limit = info.window_height if info else view.page_size
+    view.clear()
+    view.extend(load_history(None, limit))
+    # messages still being sent, or that failed to, stay under the channel
+    view.extend((key, line) for key, (sent_to, _, line) in outgoing.items()
+                if sent_to == channel)
+
+
+def show_backfilled(channel, messages):
+    """count backfilled messages and show them if they belong in the view.
+    The view is only reloaded, which puts them in order, when nothing in it
+    would be lost, otherwise they are added after what is shown. While
+    scrolled back they show up once the user pages back down."""
+    active_channel_sid = channel_list.current
+    for message in messages:
+        unread.add(message, read=channel == active_channel_sid)
+    if channel != active_channel_sid or view.detached:
+        return
+    if view.has_local:
+        view.extend((message.id, render(message, highlights.highlight))
+                    for message in messages)
     else:
-        """When a user switches channels, we want to clear the messages
-        in the current channel and show the messages from the new channel.
-        When they come back to a previous channel, they expect to see the
-        messages they left there (+new unread ones if any). Fetching all
-        channel messages from the server each time would be expensive,
-        so save chat in sqlite db and fetch from there."""
-        if not from_db:
-            try:
-                msg_data = message.split(None, 2)
-                c.execute('INSERT INTO history VALUES (NULL,?,?,?,?)',
-                          (msg_data[0], msg_data[1], msg_data[2],
-                           channel))
-                conn.commit()
-                # show notification if user is @mentioned
-                if f'@{identity}' in msg_data[2].split():
-                    mentioned_channel = [ch[1] for ch in utils.get_channels() if ch[0] == channel][0]
-                    n.update('cchat',
-                             f'You\'ve been mentioned on #{mentioned_channel}')
-                    n.show()
-            except IndexError:
-                # not a chat message
-                pass
-            except Exception as e:
-                conn.rollback()
-                output = output_field.text + "{}\n".format(e)
-                output_field.document = Document(
-                    text=output, cursor_position=len(output),
-                )
+        show_history(channel)
 
 
 # key bindings.
@@ -222,30 +372,25 @@ def tab_(event):
     focus_next(event)
 
 
-@Condition
-def input_buffer_active():
-    """Only activate 'enter' key binding if input buffer is not active"""
-    if not get_app().layout.buffer_has_focus:
-        active_channel = channels_window.values[channels_window._selected_index][1]
-        active_channel_sid = channels_window.values[channels_window._selected_index][0]
-        channels_window.current_value = active_channel_sid
-        output_window.title = f"#{active_channel}"
-        c.execute('SELECT * FROM history WHERE channel=?',
-                  (active_channel_sid,))
-        chat_history = c.fetchall()
-        output_field.document = Document(
-            text='', cursor_position=0,
-        )
-        buffer = Application.current_buffer
-        chat_handler(buffer,
-                     process_response(chat_history, True),
-                     active_channel_sid,
-                     True)
-
-
-@bindings.add('enter', filter=input_buffer_active)
-def enter_(event):
-    pass
+def switch_channel(channel):
+    previous = channel_list.current
+    channel_list.current = channel_list.selected = channel
+    output_window.title = f"#{channel_list.names.get(channel, channel)}"
+    unread.mark_read(previous)
+    unread.mark_read(channel)
+    show_history(channel)
+
+
+@bindings.add('pageup')
+def pageup_(event):
+    """scroll back, loading older messages from history"""
+    view.page_older()
+
+
+@bindings.add('pagedown')
+def pagedown_(event):
+    """jump back to the newest messages"""
+    view.page_newer()
 
 
 # Style.
@@ -261,40 +406,53 @@ def command_handler(buffer):
     # input starting with '/' is treated as a command
     try:
         if input_field.text.startswith('/'):  # command
-            cmd_response = utils.command_handler(input_field.text)
-            output = f"{cmd_response}\n"
-            new_text = output_field.text + output
-            output_field.document = Document(
-                text=new_text, cursor_position=len(new_text),
-            )
+            cmd_response = utils.command_handler(
+                input_field.text,
+                report=lambda text: run_in_ui(view.append, text),
+                history=history,
+                on_backfill=lambda *args: run_in_ui(show_backfilled, *args))
+            view.append(cmd_response)
             if cmd_response.find('Error') == -1 and \
-                    input_field.text.find('channel') != -1:
+                    input_field.text.startswith(('/+channel ', '/-channel ')):
                 # channel command - refresh channel list
-                channels_window.values = utils.get_channels()
-                channels_window.current_value = general_ch
-                output_window.title = "#general"
-                c.execute('SELECT * FROM history WHERE channel=?',
-                          (general_ch,))
-                chat_history = c.fetchall()
-                output_field.document = Document(
-                    text='', cursor_position=0,
-                )
-                buffer = Application.current_buffer
-                chat_handler(buffer,
-                             process_response(chat_history, True),
-                             general_ch,
-                             True)
+                set_channels(utils.get_channels())
+                switch_channel(general_ch)
         elif input_field.text.strip():  # message
-            utils.send_message(channels_window.current_value,
-                               input_field.text)
+            key = outbox.send(channel_list.current,
+                              input_field.text)
+            line = f"{ansi_italics}sending: {input_field.text}{ansi_end}"
+            outgoing[key] = (channel_list.current, input_field.text, line)
+            view.append(line, key)
     except BaseException as e:
-        output = f"\n\n{e}"
-        new_text = output_field.text + output
-        output_field.document = Document(
-            text=new_text, cursor_position=len(new_text),
-        )
+        view.append(f"\n\n{e}")
 
 
+def show_send_status(key, status, error=None):
+    """the webhook shows sent messages, so only failures stay in view.
+    A failure is shown wherever the user is if its line isn't in view,
+    e.g. after switching channels."""
+    channel, body, _ = outgoing.pop(key, (None, '', None))
+    if status == SENT:
+        view.remove(key)
+        return
+    line = f"{utils.ansi_red}failed to send: {body} ({error}){ansi_end}"
+    outgoing[key] = (channel, body, line)
+    if not view.replace(key, line):
+        name = channel_list.names.get(channel, channel)
+        view.append(f"{utils.ansi_red}failed to send to #{name}: {body} "
+                    f"({error}){ansi_end}")
+
+
+# (channel, body, line shown) of the messages being sent or that failed
+# to, by outbox key, their lines are kept across show_history
+outgoing = {}
+outbox = Outbox(
+    utils.send_message,
+    workers=utils.config.getint('outbox', 'workers', fallback=2),
+    retries=utils.config.getint('outbox', 'retries', fallback=3),
+    on_status=lambda *args: run_in_ui(show_send_status, *args),
+)
+
 input_field.accept_handler = command_handler
 spinner.succeed("interface rendered")
 
@@ -306,19 +464,29 @@ application = Application(
     style=style,
     mouse_support=True,
     full_screen=True,
+    min_redraw_interval=1 / max_fps,
     erase_when_done=True,
 )
 spinner.succeed("all good")
 
 
 def main():
-    # start server
-    daemon = threading.Thread(name='daemon_server',
-                              target=chat_server)
+    # start server, or listen to the relay hub
+    if relay is not None:
+        daemon = threading.Thread(name='relay_client', target=relay.run)
+    else:
+        daemon = threading.Thread(name='daemon_server', target=chat_server,
+                                  args=(events,),
+                                  kwargs={'capture': capture, 'seen': seen,
+                                          'backlog': backlog})
     daemon.setDaemon(True)  # killed once the main thread is dead
     daemon.start()
     # start app
-    application.run()
+    application.run(pre_run=start_ui)
+    unread.mark_read(channel_list.current)
+    history.close()
+    if capture is not None:
+        capture.close()
 
 
 if __name__ == "__main__":
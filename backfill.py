@@ -0,0 +1,100 @@
+"""fetch the messages sent while the app wasn't running into history"""
+
+import calendar
+
+from jobs import BulkJob
+from message import MESSAGE, Message, parse_timestamp
+
+
+def from_api(channel, record):
+    """Message from a twilio chat message resource"""
+    created = record.date_created
+    if isinstance(created, str):
+        # left as a string by the client when it isn't in the format it
+        # expects, e.g. with milliseconds like webhooks send it
+        try:
+            created = parse_timestamp(created)
+        except ValueError:
+            created = None
+    elif created is not None:
+        created = calendar.timegm(created.utctimetuple())
+    return Message(MESSAGE, channel, record.from_, record.body, created or 0,
+                   record.sid, record.index)
+
+
+class Backfill:
+    """Fetches the message lists of `channels` from the api, newest first,
+    on a BulkJob worker pool with every page fetch counted against `rate`.
+
+    A channel is read back to the newest message index backfilled on the
+    previous run (its cursor), or up to `max_messages` messages the first
+    time. Messages already stored, e.g. by the webhook, are skipped and the
+    rest are queued into history a page at a time, so the writer thread
+    inserts them in batches. The cursor only moves once a channel has been
+    read back all the way, so an interrupted run is picked up next time.
+
+    `pages(channel, page_size)` yields pages of message resources, newest
+    first, and `on_messages(channel, messages)` is called with each batch
+    stored, oldest first.
+    """
+
+    def __init__(self, history, pages, channels, describe=str, workers=4,
+                 rate=10, page_size=100, max_messages=1000, report=print,
+                 on_messages=None):
+        self.history = history
+        self.pages = pages
+        self.page_size = page_size
+        self.max_messages = max_messages
+        self.describe = describe
+        self.report = report
+        self.on_messages = on_messages
+        self.job = BulkJob('backfill', self._channel, channels,
+                           describe=describe, workers=workers, rate=rate,
+                           report=report)
+
+    @property
+    def running(self):
+        return self.job.running
+
+    def start(self):
+        self.job.start()
+
+    def cancel(self):
+        self.job.cancel()
+
+    def _channel(self, channel):
+        cursor = self.history.backfill_cursor(channel)
+        stored = self.history.indexes(channel, after=cursor)
+        newest, fetched, added = cursor, 0, 0
+        pages = self.pages(channel, self.page_size)
+        done = False
+        while not done:
+            page = next(pages, None)
+            if not page:
+                break
+            messages = []
+            for record in page:
+                if cursor is not None and record.index <= cursor:
+                    done = True
+                    break
+                if newest is None or record.index > newest:
+                    newest = record.index
+                if record.index not in stored:
+                    messages.append(from_api(channel, record))
+                fetched += 1
+                if cursor is None and fetched >= self.max_messages:
+                    done = True
+                    break
+            if messages:
+                messages.reverse()
+                self.history.add_many(messages)
+                added += len(messages)
+                if self.on_messages is not None:
+                    self.on_messages(channel, messages)
+            if not done:
+                self.job.limiter.wait()  # before fetching the next page
+        if newest is not None and newest != cursor:
+            self.history.set_backfill_cursor(channel, newest)
+        if added:
+            self.report(f"backfill: {added} new messages in "
+                        f"{self.describe(channel)}")
@@ -0,0 +1,223 @@
+"""local stand-in for the twilio programmable chat rest api
+
+Keeps services, channels, users and messages in memory and, like twilio,
+calls the chat webhook when a message is posted with the
+X-Twilio-Webhook-Enabled header. Point cchat at it with
+TWILIO_CHAT_URL=http://localhost:PORT.
+"""
+
+import itertools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlencode, urlsplit
+from urllib.request import urlopen
+
+PAGE_SIZE = 50
+
+
+def _now(when=None):
+    """timestamp as the rest api formats it, to the second"""
+    return (when or datetime.now(timezone.utc)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _webhook_time(when):
+    """timestamp as webhooks format it, with milliseconds"""
+    return when.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class FakeChatService:
+    """in-memory state of one chat service"""
+
+    def __init__(self, sid='ISfake', webhook_url=None, webhook_workers=8):
+        self.sid = sid
+        self.webhook_url = webhook_url
+        self.channels = {}   # sid -> channel dict
+        self.users = {}      # sid -> user dict
+        self.messages = {}   # channel sid -> list of message dicts
+        self._sids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._webhooks = ThreadPoolExecutor(max_workers=webhook_workers)
+        self.create_channel('general', 'General Chat Channel')
+
+    def _sid(self, prefix):
+        return f'{prefix}{next(self._sids):032x}'
+
+    def channel(self, key):
+        """look a channel up by sid or unique name"""
+        if key in self.channels:
+            return self.channels[key]
+        for channel in self.channels.values():
+            if channel['unique_name'] == key:
+                return channel
+        return None
+
+    def create_channel(self, unique_name, friendly_name=None,
+                       created_by='system'):
+        with self._lock:
+            sid = self._sid('CH')
+            self.channels[sid] = {
+                'sid': sid, 'service_sid': self.sid,
+                'unique_name': unique_name,
+                'friendly_name': friendly_name or unique_name,
+                'created_by': created_by, 'type': 'public',
+                'attributes': '{}', 'members_count': 0,
+                'messages_count': 0, 'date_created': _now(),
+                'date_updated': _now(),
+            }
+            self.messages[sid] = []
+        return self.channels[sid]
+
+    def post_message(self, channel, sender, body, webhook=True):
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            messages = self.messages[channel['sid']]
+            message = {
+                'sid': self._sid('IM'), 'service_sid': self.sid,
+                'channel_sid': channel['sid'], 'index': len(messages),
+                'from': sender, 'body': body, 'attributes': '{}',
+                'date_created': _now(now), 'date_updated': _now(now),
+            }
+            messages.append(message)
+            channel['messages_count'] += 1
+        if webhook and self.webhook_url:
+            self._webhooks.submit(self._call_webhook, message,
+                                  _webhook_time(now))
+        return message
+
+    def _call_webhook(self, message, date_created):
+        query = urlencode({
+            'EventType': 'onMessageSent',
+            'ChannelSid': message['channel_sid'],
+            'MessageSid': message['sid'],
+            'Index': message['index'],
+            'From': message['from'],
+            'Body': message['body'],
+            'DateCreated': date_created,
+        })
+        try:
+            urlopen(f'{self.webhook_url}/?{query}', timeout=10).read()
+        except OSError:
+            pass
+
+
+class FakeTwilio(BaseHTTPRequestHandler):
+    """routes the subset of /v2/Services/... used by cchat"""
+
+    def _send(self, status, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        # v2 / Services / {sid} / Collection [/ {sid} [/ Collection]]
+        if len(parts) < 4 or parts[:2] != ['v2', 'Services']:
+            return None, parts, parse_qs(url.query)
+        return self.server.service, parts[3:], parse_qs(url.query)
+
+    def _form(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode())
+        return {key: values[0] for key, values in form.items()}
+
+    def _page(self, key, items, query):
+        page = int(query.get('Page', ['0'])[0])
+        size = int(query.get('PageSize', [str(PAGE_SIZE)])[0])
+        start = page * size
+        more = start + size < len(items)
+        base = f'http://{self.headers["Host"]}{urlsplit(self.path).path}'
+        next_url = f'{base}?Page={page + 1}&PageSize={size}' if more else None
+        if next_url and 'Order' in query:
+            next_url += f'&Order={query["Order"][0]}'
+        return {
+            key: items[start:start + size],
+            'meta': {'page': page, 'page_size': size, 'key': key,
+                     'url': self.path, 'first_page_url': self.path,
+                     'previous_page_url': None, 'next_page_url': next_url},
+        }
+
+    def do_GET(self):
+        service, parts, query = self._route()
+        if service is None:
+            return self._send(404, {'status': 404, 'message': 'not found'})
+        if parts == ['Channels']:
+            return self._send(200, self._page(
+                'channels', list(service.channels.values()), query))
+        if parts == ['Users']:
+            return self._send(200, self._page(
+                'users', list(service.users.values()), query))
+        if len(parts) >= 2 and parts[0] == 'Channels':
+            channel = service.channel(parts[1])
+            if channel is None:
+                return self._send(404, {'status': 404,
+                                        'message': 'channel not found'})
+            if len(parts) == 2:
+                return self._send(200, channel)
+            if parts[2] == 'Messages':
+                messages = list(service.messages[channel['sid']])
+                if query.get('Order', ['asc'])[0] == 'desc':
+                    messages.reverse()
+                return self._send(200, self._page('messages', messages,
+                                                  query))
+        return self._send(404, {'status': 404, 'message': 'not found'})
+
+    def do_POST(self):
+        service, parts, _ = self._route()
+        form = self._form()
+        if service is None:
+            return self._send(404, {'status': 404, 'message': 'not found'})
+        if parts == ['Channels']:
+            return self._send(201, service.create_channel(
+                form.get('UniqueName'), form.get('FriendlyName'),
+                form.get('CreatedBy', 'system')))
+        if len(parts) == 3 and parts[0] == 'Channels':
+            channel = service.channel(parts[1])
+            if channel is None:
+                return self._send(404, {'status': 404,
+                                        'message': 'channel not found'})
+            if parts[2] == 'Messages':
+                webhook = self.headers.get(
+                    'X-Twilio-Webhook-Enabled') == 'true'
+                return self._send(201, service.post_message(
+                    channel, form.get('From', 'system'), form.get('Body', ''),
+                    webhook=webhook))
+            if parts[2] == 'Members':
+                channel['members_count'] += 1
+                return self._send(201, {'identity': form.get('Identity'),
+                                        'channel_sid': channel['sid']})
+        return self._send(404, {'status': 404, 'message': 'not found'})
+
+    def do_DELETE(self):
+        service, parts, _ = self._route()
+        if service is not None and len(parts) == 2:
+            if parts[0] == 'Channels':
+                channel = service.channel(parts[1])
+                if channel is not None:
+                    del service.channels[channel['sid']]
+                    return self._send(204)
+            elif parts[0] == 'Users' and parts[1] in service.users:
+                del service.users[parts[1]]
+                return self._send(204)
+        return self._send(404, {'status': 404, 'message': 'not found'})
+
+    def log_message(self, format, *args):
+        """suppress logs"""
+        return
+
+
+def fake_twilio(service, addr='localhost', port=0):
+    """start the stand-in on a background thread, returns the server;
+    port 0 picks a free port, see server.server_address"""
+    httpd = ThreadingHTTPServer((addr, port), FakeTwilio)
+    httpd.daemon_threads = True
+    httpd.service = service
+    threading.Thread(name='fake_twilio', target=httpd.serve_forever,
+                     daemon=True).start()
+    return httpd
@@ -0,0 +1,90 @@
+"""webhook load generator"""
+
+import itertools
+import threading
+import time
+from datetime import datetime, timezone
+from http.client import HTTPConnection
+from urllib.parse import urlencode
+
+
+def channel_sids(count):
+    return [f'CH{number:032x}' for number in range(count)]
+
+
+def webhook_query(channel, index, sender='bench', body=None):
+    """query string of an onMessageSent webhook, as twilio sends it"""
+    now = datetime.now(timezone.utc)
+    return urlencode({
+        'EventType': 'onMessageSent',
+        'ChannelSid': channel,
+        'MessageSid': f'IM{channel[-16:]}{index:016x}',
+        'Index': index,
+        'From': sender,
+        'Body': body or f'load test message {index} @someone',
+        'DateCreated': now.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+    })
+
+
+class LoadGenerator:
+    """Calls the webhook server at `rate` requests per second for
+    `duration` seconds, spreading messages over `channels` channels
+    round robin, from `connections` client threads."""
+
+    def __init__(self, host, port, rate=100, duration=10, channels=10,
+                 connections=4):
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.duration = duration
+        self.channels = channel_sids(channels)
+        self.connections = connections
+        self.sent = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._indexes = {channel: itertools.count() for channel in self.channels}
+        self._next = itertools.cycle(self.channels)
+
+    def _query(self):
+        with self._lock:
+            channel = next(self._next)
+            index = next(self._indexes[channel])
+        return webhook_query(channel, index)
+
+    def _client(self, start, interval):
+        deadline = start + self.duration
+        send_at = start
+        while send_at < deadline:
+            delay = send_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            # the server closes the connection after every request (HTTP/1.0)
+            conn = HTTPConnection(self.host, self.port, timeout=10)
+            try:
+                conn.request('GET', f'/?{self._query()}')
+                conn.getresponse().read()
+                sent, errors = 1, 0
+            except OSError:
+                sent, errors = 0, 1
+            finally:
+                conn.close()
+            with self._lock:
+                self.sent += sent
+                self.errors += errors
+            send_at += interval
+
+    def run(self):
+        """send the load, returns once every client thread is done"""
+        interval = self.connections / self.rate
+        start = time.perf_counter()
+        clients = [
+            threading.Thread(target=self._client,
+                             args=(start + number * interval / self.connections,
+                                   interval))
+            for number in range(self.connections)
+        ]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        return time.perf_counter() - start
@@ -0,0 +1,96 @@
+"""replay captured webhook traffic through parsing, storage and rendering,
+without twilio or the terminal ui
+
+    python -m bench.replay cchat.capture            # at the original pace
+    python -m bench.replay cchat.capture --speed 0  # as fast as possible
+
+Capture traffic by setting `capture = PATH` under [server] in .cchat.cfg.
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from bench.run import HeadlessSink, percentile
+from capture import read_capture
+from history import HistoryStore
+from ingest import EventQueue, SeenSet
+from message import parse_webhook
+
+
+def replay(records, events, speed=1.0):
+    """put the parsed requests on `events`, spaced out as they arrived
+    divided by `speed`, or back to back if speed is 0, dropping retried
+    ones like the webhook server does. Returns the number of requests
+    replayed and how many of them were retries."""
+    seen = SeenSet()
+    started = first = None
+    count = duplicates = 0
+    for arrived, query in records:
+        if speed:
+            if started is None:
+                started, first = time.perf_counter(), arrived
+            delay = started + (arrived - first) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        received = time.perf_counter()
+        message = parse_webhook(query)
+        count += 1
+        if message.sid is not None and not seen.add(message.sid):
+            duplicates += 1
+            continue
+        message.received = received
+        events.put(message)
+    return count, duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('capture', help='file recorded with [server] capture')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed, 2 is twice as fast, '
+                             '0 is as fast as possible')
+    parser.add_argument('--history', default=None,
+                        help='history database to write to, a new one in a '
+                             'temporary directory by default')
+    parser.add_argument('--channel', default=None,
+                        help='channel sid shown in the headless view')
+    parser.add_argument('--queue-size', type=int, default=1000)
+    parser.add_argument('--backpressure', default='block')
+    args = parser.parse_args()
+
+    path = args.history or os.path.join(
+        tempfile.mkdtemp(prefix='cchat-replay-'), 'history.db')
+    history = HistoryStore(path)
+    events = EventQueue(args.queue_size, args.backpressure)
+    sink = HeadlessSink(events, history, args.channel)
+    consumer = threading.Thread(target=sink.run, daemon=True)
+    consumer.start()
+
+    started = time.perf_counter()
+    sent, duplicates = replay(read_capture(args.capture), events, args.speed)
+    while sink.handled + events.dropped + duplicates < sent:
+        time.sleep(0.01)
+    history.flush()
+    elapsed = time.perf_counter() - started
+    sink.stop()
+    history.close()
+
+    print(f"replayed {sent} webhooks in {elapsed:.2f}s "
+          f"({'as fast as possible' if not args.speed else f'{args.speed:g}x'})")
+    print(f"handled {sink.handled}, dropped {events.dropped}, "
+          f"retries {duplicates}, "
+          f"throughput {sink.handled / max(elapsed, 1e-9):.1f} msg/s")
+    if sink.latencies:
+        print(f"ingest-to-display latency: "
+              f"p50 {percentile(sink.latencies, 50) * 1000:.2f}ms "
+              f"p99 {percentile(sink.latencies, 99) * 1000:.2f}ms "
+              f"mean {statistics.mean(sink.latencies) * 1000:.2f}ms")
+    print(f"history written to {path}")
+
+
+if __name__ == '__main__':
+    main()
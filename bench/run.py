@@ -0,0 +1,213 @@
+"""end-to-end load benchmark, runs without twilio or the terminal ui
+
+    python -m bench.run --rate 500 --duration 30 --channels 20
+    python -m bench.run --rest          # send through the outbox and a
+                                        # local twilio stand-in instead
+
+Reports throughput, ingest-to-display latency percentiles and memory
+growth over the run.
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+
+from prompt_toolkit.buffer import Buffer
+
+from bench.fake_twilio import FakeChatService, fake_twilio
+from bench.load import LoadGenerator, channel_sids
+from history import HistoryStore
+from ingest import EventQueue, Resequencer, SeenSet
+from message import MESSAGE, render
+from server import make_server
+from view import MessageView
+
+
+class HeadlessSink:
+    """Stands in for the terminal ui: stores and renders queued messages
+    the way app.chat_handler does, recording ingest-to-display latency."""
+
+    def __init__(self, events, history, active_channel, scrollback=1000,
+                 interval=0.001, reorder_window=1.0):
+        self.events = events
+        self.resequencer = Resequencer(reorder_window,
+                                       next_index=history.next_indexes())
+        self.history = history
+        self.active_channel = active_channel
+        self.interval = interval
+        self.view = MessageView(Buffer(), scrollback=scrollback)
+        # compact so it barely shows up in the memory growth figures
+        self.latencies = array('d')
+        self.handled = 0
+        self._stop = threading.Event()
+
+    def handle(self, message):
+        if message.event == MESSAGE:
+            self.history.add(message)
+        text = render(message)
+        if message.channel == self.active_channel:
+            self.view.append(text, message.id)
+        if message.received is not None:
+            self.latencies.append(time.perf_counter() - message.received)
+        self.handled += 1
+
+    def run(self):
+        while not self._stop.is_set():
+            messages = self.resequencer.release(self.events.drain())
+            for message in messages:
+                self.handle(message)
+            if not messages:
+                time.sleep(self.interval)
+
+    def stop(self):
+        self._stop.set()
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class MemorySampler:
+    """samples traced memory every `interval` seconds"""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.samples.append((time.perf_counter(),
+                                 tracemalloc.get_traced_memory()[0]))
+
+    def stop(self):
+        self._stop.set()
+
+
+def rest_load(args, webhook_port):
+    """post messages through utils.send_message and the outbox to a local
+    twilio stand-in, which calls the webhook like twilio does"""
+    service = FakeChatService(webhook_url=f'http://localhost:{webhook_port}')
+    for number in range(args.channels - 1):
+        service.create_channel(f'bench{number}')
+    rest = fake_twilio(service)
+    os.environ['TWILIO_CHAT_URL'] = f'http://localhost:{rest.server_address[1]}'
+    os.environ.setdefault('CHAT_SERVICE_SID', service.sid)
+    os.environ.setdefault('ACCOUNT_SID', 'ACbench')
+    os.environ.setdefault('AUTH_TOKEN', 'bench')
+
+    import utils
+    from outbox import Outbox
+    utils.chat_url = os.environ['TWILIO_CHAT_URL']
+    utils.chat_service_sid = service.sid
+    utils.account_sid = os.environ['ACCOUNT_SID']
+    utils.auth_token = os.environ['AUTH_TOKEN']
+    utils._client = None  # made again with the credentials above
+    utils.identity = 'bench'
+    utils.config['channels'] = {'general': service.channel('general')['sid']}
+
+    started = time.perf_counter()
+    channels = [sid for sid, _ in utils.get_channels()]
+    print(f"get_channels: {len(channels)} channels in "
+          f"{(time.perf_counter() - started) * 1000:.1f}ms")
+
+    outbox = Outbox(utils.send_message, workers=args.connections)
+    interval = 1 / args.rate
+    deadline = time.perf_counter() + args.duration
+    send_at, sent = time.perf_counter(), 0
+    while send_at < deadline:
+        delay = send_at - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        outbox.send(channels[sent % len(channels)], f'load test message {sent}')
+        sent += 1
+        send_at += interval
+    return sent, 0, channels[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rate', type=float, default=200,
+                        help='webhooks per second')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds of load')
+    parser.add_argument('--channels', type=int, default=10,
+                        help='channels the messages are spread over')
+    parser.add_argument('--connections', type=int, default=4,
+                        help='concurrent client connections')
+    parser.add_argument('--queue-size', type=int, default=1000)
+    parser.add_argument('--backpressure', default='drop_oldest')
+    parser.add_argument('--rest', action='store_true',
+                        help='go through send_message and a twilio stand-in')
+    parser.add_argument('--port', type=int, default=0,
+                        help='webhook server port, 0 picks a free one')
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    workdir = tempfile.mkdtemp(prefix='cchat-bench-')
+    history = HistoryStore(os.path.join(workdir, 'history.db'))
+    events = EventQueue(args.queue_size, args.backpressure)
+    httpd = make_server(events, port=args.port, seen=SeenSet())
+    port = httpd.server_address[1]
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    sink = HeadlessSink(events, history, channel_sids(args.channels)[0])
+    sampler = MemorySampler()
+    threads = [threading.Thread(target=sink.run, daemon=True),
+               threading.Thread(target=sampler.run, daemon=True)]
+    for thread in threads:
+        thread.start()
+    memory_start = tracemalloc.get_traced_memory()[0]
+
+    started = time.perf_counter()
+    if args.rest:
+        sent, errors, sink.active_channel = rest_load(args, port)
+    else:
+        load = LoadGenerator('localhost', port, args.rate, args.duration,
+                             args.channels, args.connections)
+        load.run()
+        sent, errors = load.sent, load.errors
+
+    # let the sink catch up before stopping the clock
+    settle_deadline = time.perf_counter() + 10
+    while sink.handled + events.dropped < sent and \
+            time.perf_counter() < settle_deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    sink.stop()
+    sampler.stop()
+    history.flush()
+    memory_end = tracemalloc.get_traced_memory()[0]
+    httpd.shutdown()
+    history.close()
+
+    latencies = sink.latencies
+    print(f"sent {sent} webhooks ({errors} errors) to {args.channels} "
+          f"channels in {elapsed:.2f}s")
+    print(f"handled {sink.handled}, dropped {events.dropped}, "
+          f"throughput {sink.handled / elapsed:.1f} msg/s")
+    if latencies:
+        print(f"ingest-to-display latency: "
+              f"p50 {percentile(latencies, 50) * 1000:.2f}ms "
+              f"p99 {percentile(latencies, 99) * 1000:.2f}ms "
+              f"mean {statistics.mean(latencies) * 1000:.2f}ms")
+    growth = memory_end - memory_start
+    print(f"memory: {memory_start / 1024:.0f}KiB -> {memory_end / 1024:.0f}KiB "
+          f"({growth / 1024:+.0f}KiB, "
+          f"{growth / 1024 / max(elapsed / 60, 1e-9):+.0f}KiB/min)")
+    if len(sampler.samples) > 1:
+        peak = max(sample for _, sample in sampler.samples)
+        print(f"memory peak {peak / 1024:.0f}KiB over "
+              f"{len(sampler.samples)} samples")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""recording of raw webhook traffic, replayed with `python -m bench.replay`
+
+A capture is an append-only text file with one line per webhook request:
+the epoch time it arrived, in milliseconds, and its query string, which is
+url-encoded so it never holds a space or a newline.
+"""
+
+import threading
+import time
+
+
+class Capture:
+    """Appends webhook query strings to `path` as they arrive, from any
+    thread. Lines are buffered and written out every `flush_interval`
+    seconds at most, and on close()."""
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self._file = open(path, 'a')
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, query):
+        line = f'{int(time.time() * 1000)} {query}\n'
+        with self._lock:
+            self._file.write(line)
+            self.recorded += 1
+            now = time.monotonic()
+            if now - self._flushed_at >= self.flush_interval:
+                self._file.flush()
+                self._flushed_at = now
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(path):
+    """(arrival time in seconds, query string) for every recorded request"""
+    with open(path) as capture:
+        for line in capture:
+            millis, _, query = line.rstrip('\n').partition(' ')
+            if millis.isdigit():  # skip a line cut short by a crash
+                yield int(millis) / 1000, query
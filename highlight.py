@@ -0,0 +1,67 @@
+"""mention and keyword matching"""
+
+import re
+
+HIGHLIGHT = '\033[7m'
+HIGHLIGHT_END = '\033[27m'
+
+
+def _trie_pattern(words):
+    """regex matching any of `words`, shaped like a trie so the regex
+    engine follows one branch per character however many words there are"""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def pattern(node):
+        end = '' in node
+        branches = [re.escape(char) + pattern(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1 and not end:
+            return branches[0]
+        group = '(?:' + '|'.join(branches) + ')'
+        return group + '?' if end else group
+
+    return pattern(trie)
+
+
+class HighlightMatcher:
+    """Finds the user's highlight words in a message body in one pass.
+
+    All keywords are compiled once into a single case-insensitive regex.
+    Keywords starting with @ only match as mentions (`@bob`), other ones
+    match as whole words with or without a leading @.
+    """
+
+    def __init__(self, keywords):
+        mentions, words = set(), set()
+        for keyword in keywords:
+            keyword = keyword.strip().lower()
+            if keyword.startswith('@') and len(keyword) > 1:
+                mentions.add(keyword[1:])
+            elif keyword:
+                words.add(keyword)
+        alternatives = []
+        if mentions:
+            alternatives.append('@' + _trie_pattern(mentions))
+        if words:
+            alternatives.append('@?' + _trie_pattern(words))
+        self.pattern = re.compile(
+            r'(?<![\w@])(?:' + '|'.join(alternatives) + r')(?!\w)',
+            re.IGNORECASE) if alternatives else None
+
+    def matches(self, text):
+        return self.pattern is not None and \
+            self.pattern.search(text) is not None
+
+    def highlight(self, text):
+        """text with the matches marked up for the output pane"""
+        if self.pattern is None:
+            return text
+        return self.pattern.sub(
+            lambda match: f'{HIGHLIGHT}{match.group()}{HIGHLIGHT_END}', text)
@@ -0,0 +1,573 @@
+"""on-disk chat history"""
+
+import functools
+import itertools
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+import metrics
+from message import MESSAGE, Message
+
+write_time = metrics.histogram('cchat_history_write_seconds',
+                               'Time spent inserting and committing a batch')
+batch_sizes = metrics.histogram('cchat_history_batch_size',
+                                'Messages written per commit',
+                                buckets=metrics.SIZE_BUCKETS)
+archive_time = metrics.histogram('cchat_history_archive_seconds',
+                                 'Time spent moving a channel to the archive')
+archived = metrics.counter('cchat_history_archived_total',
+                           'Messages moved to the archive')
+
+# schema changes, applied in order and tracked with `PRAGMA user_version`
+MIGRATIONS = [
+    '''CREATE TABLE IF NOT EXISTS history
+           (id integer primary key,
+           msg_time time, sender text, msg text, channel text);
+       CREATE INDEX IF NOT EXISTS history_channel ON history (channel, id);''',
+    # raw message fields, epoch timestamps and no ansi codes in sender
+    '''CREATE TABLE messages
+           (id integer primary key, sid text, channel text,
+           msg_index integer, sender text, body text, created integer);
+       INSERT INTO messages (id, channel, sender, body, created)
+           SELECT id, channel,
+                  replace(replace(sender, char(27) || '[1m', ''),
+                          char(27) || '[0m', ''),
+                  rtrim(msg, char(10)), 0
+           FROM history;
+       DROP TABLE history;
+       ALTER TABLE messages RENAME TO history;
+       CREATE INDEX history_channel ON history (channel, id);''',
+    # full-text index, kept in step with history by triggers so it is
+    # updated incrementally in the writer thread's batches
+    '''CREATE VIRTUAL TABLE history_fts USING fts5(
+           body, sender, content='history', content_rowid='id');
+       INSERT INTO history_fts (rowid, body, sender)
+           SELECT id, body, sender FROM history;
+       CREATE TRIGGER history_fts_insert AFTER INSERT ON history BEGIN
+           INSERT INTO history_fts (rowid, body, sender)
+               VALUES (new.id, new.body, new.sender);
+       END;
+       CREATE TRIGGER history_fts_delete AFTER DELETE ON history BEGIN
+           INSERT INTO history_fts (history_fts, rowid, body, sender)
+               VALUES ('delete', old.id, old.body, old.sender);
+       END;''',
+    'CREATE TABLE read_state (channel text primary key, last_read_id integer);',
+    # backfilled messages are stored after newer ones, so pages are read in
+    # the order messages were sent rather than by id
+    '''CREATE TABLE backfill_cursor (channel text primary key,
+                                     last_index integer);
+       CREATE INDEX history_channel_index ON history (channel, msg_index);
+       CREATE INDEX history_channel_created ON history (channel, created, id);''',
+    # cold tier: messages past the retention limits, a zlib compressed
+    # segment per channel and day with senders and channels interned in
+    # names. The full-text index of the archive keeps no copy of the text.
+    '''CREATE TABLE names (id integer primary key, name text unique);
+       CREATE TABLE archive
+           (channel_id integer, day integer, min_id integer, max_id integer,
+           count integer, data blob, PRIMARY KEY (channel_id, day));
+       CREATE INDEX archive_ids ON archive (min_id, max_id);
+       CREATE VIRTUAL TABLE archive_fts USING fts5(
+           body, sender, channel, content='');''',
+    # one row per twilio message, retried webhooks are ignored on insert
+    '''DELETE FROM history WHERE sid IS NOT NULL AND id NOT IN
+           (SELECT min(id) FROM history WHERE sid IS NOT NULL GROUP BY sid);
+       CREATE UNIQUE INDEX history_sid ON history (sid);''',
+    # created is only to the second, ties go by twilio's index rather than
+    # by id, which backfill hands out newest page first
+    '''DROP INDEX history_channel_created;
+       CREATE INDEX history_channel_position
+           ON history (channel, created, coalesce(msg_index, -1), id);''',
+]
+
+# search matches are highlighted in bold
+MARK = '\033[1m'
+MARK_END = '\033[22m'
+
+_STOP = object()
+
+INSERT_MESSAGE = 'INSERT OR IGNORE INTO history VALUES (?,?,?,?,?,?,?)'
+
+DAY = 24 * 60 * 60
+
+# order of the messages in a channel: sent time, then twilio's index for
+# messages sent the same second, then the order they were stored in
+POSITION = 'created, coalesce(msg_index, -1), id'
+POSITION_DESC = 'created DESC, coalesce(msg_index, -1) DESC, id DESC'
+
+
+def _position(created, index, id):
+    return created, -1 if index is None else index, id
+
+
+def _segment_position(row):
+    """position of an [id, sid, index, sender id, body, created] row"""
+    return _position(row[5], row[2], row[0])
+
+
+def _encode(rows):
+    """archive segment from [id, sid, index, sender id, body, created] rows"""
+    return zlib.compress(json.dumps(rows, separators=(',', ':')).encode())
+
+
+@functools.lru_cache(maxsize=16)
+def _decode(data):
+    """rows of an archive segment, oldest first. Cached so paging through
+    a segment doesn't decompress it again for every page, don't modify."""
+    return json.loads(zlib.decompress(data))
+
+
+def _mark(text, terms):
+    """wrap search terms in `text` like the full-text index highlights"""
+    words = [re.escape(term) for term in terms.split()]
+    if not words:
+        return text
+    return re.sub(r'\b(' + '|'.join(words) + r')\b',
+                  lambda match: f'{MARK}{match.group()}{MARK_END}', text,
+                  flags=re.IGNORECASE)
+
+
+def migrate(conn):
+    """bring the database schema up to date"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, script in enumerate(MIGRATIONS[version:], version + 1):
+        conn.executescript(script)
+        conn.execute(f'PRAGMA user_version = {number}')
+    conn.commit()
+
+
+class HistoryStore:
+    """Chat history in an sqlite database on disk.
+
+    The database runs in WAL mode so reads never wait on the writer.
+    All writes go through one writer thread which commits in batches of
+    `batch_size` rows, or after `flush_interval` seconds, whichever comes
+    first. Every thread reading from the store gets its own connection.
+
+    Being the only writer, the store hands out row ids itself when a row
+    is queued, so callers can refer to a message before it is committed.
+
+    With `keep_messages` or `keep_days` set, an archiver thread moves a
+    channel's messages out of the history table every `archive_interval`
+    seconds once they are neither among its last `keep_messages` nor
+    newer than `keep_days`. They go to compressed per-channel, per-day
+    archive segments, which page() and search() read from when the history
+    table runs out. The archiver has its own connection and commits
+    `archive_chunk` messages at a time, so the writer thread, and flush(),
+    only ever wait on one small transaction.
+    """
+
+    def __init__(self, path, batch_size=100, flush_interval=0.5,
+                 on_error=None, keep_messages=None, keep_days=None,
+                 archive_interval=3600, archive_chunk=500):
+        self.path = os.path.expanduser(path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self.keep_messages = keep_messages
+        self.keep_days = keep_days
+        self.archive_interval = archive_interval
+        self.archive_chunk = archive_chunk
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._unflushed = 0
+        self._name_ids = {}  # archiver thread's cache of interned names
+        self._names = {}
+        self._names_by_id = {}
+
+        conn = self._reader()
+        migrate(conn)
+        last_id = max(
+            conn.execute('SELECT max(id) FROM history').fetchone()[0] or 0,
+            conn.execute('SELECT max(max_id) FROM archive').fetchone()[0] or 0)
+        self._ids = itertools.count(last_id + 1)
+
+        self._writer = threading.Thread(name='history_writer',
+                                        target=self._write_loop,
+                                        daemon=True)
+        self._writer.start()
+
+        self._archiver = None
+        self._stop_archiving = threading.Event()
+        if keep_messages or keep_days:
+            self._archiver = threading.Thread(name='history_archiver',
+                                              target=self._archive_loop,
+                                              daemon=True)
+            self._archiver.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def add(self, message):
+        """queue a message for writing and set its history id"""
+        with self._lock:
+            message.id = next(self._ids)
+            self._unflushed += 1
+        self._queue.put((INSERT_MESSAGE, message.to_row()))
+        return message.id
+
+    def add_many(self, messages):
+        """queue a batch of messages, oldest first, and set their ids"""
+        with self._lock:
+            for message in messages:
+                message.id = next(self._ids)
+            self._unflushed += len(messages)
+        for message in messages:
+            self._queue.put((INSERT_MESSAGE, message.to_row()))
+
+    def _execute(self, sql, params):
+        """queue any other write for the writer thread"""
+        with self._lock:
+            self._unflushed += 1
+        self._queue.put((sql, params))
+
+    def mark_read(self, channel, last_read_id):
+        self._execute('INSERT OR REPLACE INTO read_state VALUES (?,?)',
+                      (channel, last_read_id))
+
+    def unread(self):
+        """{channel: (unread count, newest created, newest id)} for messages
+        after each channel's last read one"""
+        rows = self._read(
+            'SELECT history.channel, count(*), max(created), max(id) '
+            'FROM history LEFT JOIN read_state USING (channel) '
+            'WHERE id > coalesce(last_read_id, 0) GROUP BY history.channel',
+            ())
+        return {channel: (count, created, last_id)
+                for channel, count, created, last_id in rows}
+
+    def backfill_cursor(self, channel):
+        """index of the newest message backfilled in a channel, or None"""
+        rows = self._read('SELECT last_index FROM backfill_cursor '
+                          'WHERE channel=?', (channel,))
+        return rows[0][0] if rows else None
+
+    def set_backfill_cursor(self, channel, last_index):
+        self._execute('INSERT OR REPLACE INTO backfill_cursor VALUES (?,?)',
+                      (channel, last_index))
+
+    def recent_sids(self, limit):
+        """sids of the last `limit` messages stored"""
+        return [sid for sid, in self._read(
+            'SELECT sid FROM history WHERE sid IS NOT NULL '
+            'ORDER BY id DESC LIMIT ?', (limit,))]
+
+    def next_indexes(self):
+        """{channel: index the channel's next message will have}"""
+        return {channel: index + 1 for channel, index in self._read(
+            'SELECT channel, max(msg_index) FROM history '
+            'WHERE msg_index IS NOT NULL GROUP BY channel', ())}
+
+    def indexes(self, channel, after=None):
+        """set of the message indexes stored for a channel after `after`"""
+        rows = self._read('SELECT msg_index FROM history WHERE channel=? '
+                          'AND msg_index>?',
+                          (channel, -1 if after is None else after))
+        return {index for index, in rows}
+
+    def flush(self):
+        """block until every queued write is committed"""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        if self._archiver is not None:
+            self._stop_archiving.set()
+            self._archiver.join()
+        self._queue.put(_STOP)
+        self._writer.join()
+
+    def _read(self, sql, params):
+        if self._unflushed:
+            self.flush()
+        return self._reader().execute(sql, params).fetchall()
+
+    def page(self, channel, before_id=None, limit=50):
+        """`limit` Messages of a channel sent before the one with id
+        `before_id`, oldest first. Returns the newest page if before_id is
+        None."""
+        if before_id is None:
+            before = None
+            rows = self._read('SELECT * FROM history WHERE channel=? '
+                              f'ORDER BY {POSITION_DESC} LIMIT ?',
+                              (channel, limit))
+        else:
+            before = self._position(before_id)
+            if before is None:
+                return []
+            rows = self._read('SELECT * FROM history WHERE channel=? '
+                              f'AND ({POSITION}) < (?, ?, ?) '
+                              f'ORDER BY {POSITION_DESC} LIMIT ?',
+                              (channel, *before, limit))
+        messages = [Message.from_row(row) for row in rows]
+        if len(messages) < limit:
+            if messages:
+                last = messages[-1]
+                before = _position(last.created, last.index, last.id)
+            messages += self._archived(channel, before,
+                                       limit - len(messages))
+        messages.reverse()
+        return messages
+
+    def _position(self, id):
+        """position of a message in its channel, to page from"""
+        rows = self._read(f'SELECT {POSITION} FROM history WHERE id=?', (id,))
+        if rows:
+            return rows[0]
+        message = self._archived_message(id)
+        if message is None:
+            return None
+        return _position(message.created, message.index, message.id)
+
+    def search(self, terms, channel=None, limit=10, offset=0):
+        """full-text search, returns (total hits, Messages best match
+        first) with the matched terms in the body wrapped in `mark`"""
+        query = ' '.join('"' + term.replace('"', '""') + '"'
+                         for term in terms.split())
+        where = 'history_fts MATCH ?'
+        params = [query]
+        if channel is not None:
+            where += ' AND history.channel = ?'
+            params.append(channel)
+        total = self._read('SELECT count(*) FROM history_fts '
+                           'JOIN history ON history.id = history_fts.rowid '
+                           f'WHERE {where}', params)[0][0]
+        rows = self._read(
+            'SELECT history.id, sid, channel, msg_index, history.sender, '
+            f"highlight(history_fts, 0, '{MARK}', '{MARK_END}'), created "
+            'FROM history_fts JOIN history ON history.id = history_fts.rowid '
+            f'WHERE {where} ORDER BY rank LIMIT ? OFFSET ?',
+            params + [limit, offset])
+        messages = [Message.from_row(row) for row in rows]
+
+        # then the archive, ranked on its own after the recent messages
+        query = f'{{body sender}} : ({query})'
+        if channel is not None:
+            query += ' AND channel : "' + channel.replace('"', '""') + '"'
+        archived_total = self._read('SELECT count(*) FROM archive_fts '
+                                    'WHERE archive_fts MATCH ?',
+                                    (query,))[0][0]
+        if archived_total and len(messages) < limit:
+            ids = self._read('SELECT rowid FROM archive_fts '
+                             'WHERE archive_fts MATCH ? ORDER BY rank '
+                             'LIMIT ? OFFSET ?',
+                             (query, limit - len(messages),
+                              max(0, offset - total)))
+            for id, in ids:
+                message = self._archived_message(id)
+                if message is not None:
+                    message.body = _mark(message.body, terms)
+                    messages.append(message)
+        return total + archived_total, messages
+
+    def _name(self, name_id):
+        if name_id is not None and name_id not in self._names_by_id:
+            self._load_names()
+        return self._names_by_id.get(name_id)
+
+    def _name_id(self, name):
+        if name not in self._names:
+            self._load_names()
+        return self._names.get(name)
+
+    def _load_names(self):
+        rows = self._reader().execute('SELECT id, name FROM names').fetchall()
+        self._names_by_id = dict(rows)
+        self._names = {name: name_id for name_id, name in rows}
+
+    def _message(self, channel, row):
+        id, sid, index, sender_id, body, created = row
+        return Message(MESSAGE, channel, self._name(sender_id), body, created,
+                       sid, index, id)
+
+    def _archived(self, channel, before, limit):
+        """`limit` archived Messages of a channel before the position
+        `before`, newest first"""
+        channel_id = self._name_id(channel)
+        if channel_id is None:
+            return []
+        sql = 'SELECT data FROM archive WHERE channel_id=?'
+        params = [channel_id]
+        if before is not None:
+            sql += ' AND day<=?'
+            params.append(before[0] // DAY)
+        messages = []
+        for data, in self._reader().execute(sql + ' ORDER BY day DESC',
+                                            params):
+            for row in reversed(_decode(data)):
+                if before is None or _segment_position(row) < tuple(before):
+                    messages.append(self._message(channel, row))
+                    if len(messages) == limit:
+                        return messages
+        return messages
+
+    def _archived_message(self, id):
+        segments = self._reader().execute(
+            'SELECT channel_id, data FROM archive '
+            'WHERE min_id<=? AND max_id>=?', (id, id)).fetchall()
+        for channel_id, data in segments:
+            for row in _decode(data):
+                if row[0] == id:
+                    return self._message(self._name(channel_id), row)
+        return None
+
+    def _write_loop(self):
+        conn = self._connect()
+        stop = False
+        while not stop:
+            rows, waiters = [], []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    stop = True
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                rows.append(item)
+                if len(rows) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(
+                        timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if rows:
+                self._write(conn, rows)
+            for waiter in waiters:
+                waiter.set()
+        conn.close()
+
+    def _write(self, conn, rows):
+        """write a batch of (sql, params) in one transaction, runs of the
+        same statement go through executemany"""
+        try:
+            with write_time.time():
+                start = 0
+                for end in range(1, len(rows) + 1):
+                    if end == len(rows) or rows[end][0] != rows[start][0]:
+                        conn.executemany(rows[start][0],
+                                         [params for _, params in
+                                          rows[start:end]])
+                        start = end
+                conn.commit()
+            batch_sizes.observe(len(rows))
+        except sqlite3.Error as e:
+            conn.rollback()
+            if self.on_error is not None:
+                self.on_error(e)
+        finally:
+            with self._lock:
+                self._unflushed -= len(rows)
+
+    def _intern(self, conn, name):
+        """id of a sender or channel name, added to names if it's new"""
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            conn.execute('INSERT OR IGNORE INTO names (name) VALUES (?)',
+                         (name,))
+            name_id = self._name_ids[name] = conn.execute(
+                'SELECT id FROM names WHERE name=?', (name,)).fetchone()[0]
+        return name_id
+
+    def _archive_loop(self):
+        conn = self._connect()
+        while True:
+            self._archive(conn)
+            if self._stop_archiving.wait(self.archive_interval):
+                break
+        conn.close()
+
+    def _archive(self, conn):
+        """move the messages past the retention limits to the archive,
+        oldest first, `archive_chunk` of them per transaction"""
+        channels = [channel for channel, in
+                    conn.execute('SELECT DISTINCT channel FROM history')]
+        for channel in channels:
+            while True:
+                rows = self._archivable(conn, channel)
+                if not rows or not self._archive_rows(conn, channel, rows) \
+                        or len(rows) < self.archive_chunk:
+                    break
+                # give the writer thread a turn at the database lock, its
+                # busy handler backs off and could keep missing it
+                if self._stop_archiving.wait(0.05):
+                    return
+
+    def _archivable(self, conn, channel):
+        """the next chunk of a channel's messages past the limits"""
+        where, params = ['channel=?'], [channel]
+        if self.keep_messages:
+            # the newest message that isn't kept
+            boundary = conn.execute(
+                f'SELECT {POSITION} FROM history WHERE channel=? '
+                f'ORDER BY {POSITION_DESC} LIMIT 1 OFFSET ?',
+                (channel, self.keep_messages)).fetchone()
+            if boundary is None:
+                return []
+            where.append(f'({POSITION}) <= (?, ?, ?)')
+            params += boundary
+        if self.keep_days:
+            where.append('created < ?')
+            params.append(int(time.time()) - self.keep_days * DAY)
+        return conn.execute(f'SELECT * FROM history '
+                            f'WHERE {" AND ".join(where)} '
+                            f'ORDER BY {POSITION} LIMIT ?',
+                            params + [self.archive_chunk]).fetchall()
+
+    def _archive_rows(self, conn, channel, rows):
+        """move rows to the archive in one transaction, returns False if
+        that failed"""
+        try:
+            with archive_time.time():
+                channel_id = self._intern(conn, channel)
+                for day, day_rows in itertools.groupby(
+                        rows, key=lambda row: row[6] // DAY):
+                    segment = [
+                        [id, sid, index,
+                         None if sender is None else self._intern(conn, sender),
+                         body, created]
+                        for id, sid, _, index, sender, body, created in day_rows]
+                    existing = conn.execute(
+                        'SELECT data FROM archive WHERE channel_id=? AND day=?',
+                        (channel_id, day)).fetchone()
+                    if existing is not None:
+                        segment = _decode(existing[0]) + segment
+                        segment.sort(key=_segment_position)
+                    ids = [row[0] for row in segment]
+                    conn.execute(
+                        'INSERT OR REPLACE INTO archive VALUES (?,?,?,?,?,?)',
+                        (channel_id, day, min(ids), max(ids), len(segment),
+                         _encode(segment)))
+                conn.executemany(
+                    'INSERT INTO archive_fts (rowid, body, sender, channel) '
+                    'VALUES (?,?,?,?)',
+                    [(row[0], row[5], row[4], channel) for row in rows])
+                conn.executemany('DELETE FROM history WHERE id=?',
+                                 [(row[0],) for row in rows])
+                conn.commit()
+            archived.inc(len(rows))
+            return True
+        except sqlite3.Error as e:
+            conn.rollback()
+            self._name_ids.clear()  # may hold ids that were rolled back
+            if self.on_error is not None:
+                self.on_error(e)
+            return False
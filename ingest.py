@@ -0,0 +1,165 @@
+"""hand-off between the webhook server threads and the ui thread"""
+
+import collections
+import heapq
+import itertools
+import queue
+import threading
+import time
+
+BACKPRESSURE_POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+
+class EventQueue:
+    """Bounded queue of parsed webhook events.
+
+    The webhook server acknowledges every request immediately and puts
+    the parsed event here; the ui thread drains it. When the ui falls
+    behind, `policy` decides what happens to new events:
+
+    block       - the webhook thread waits up to `timeout` seconds for room
+    drop_oldest - the oldest queued event is discarded to make room
+    drop_newest - the incoming event is discarded
+    """
+
+    def __init__(self, maxsize=1000, policy='drop_oldest', timeout=5.0):
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"unknown backpressure policy '{policy}', "
+                             f"expected one of {BACKPRESSURE_POLICIES}")
+        self.policy = policy
+        self.timeout = timeout
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def put(self, event):
+        """queue an event, returns False if it was dropped"""
+        if self.policy == 'block':
+            try:
+                self._queue.put(event, timeout=self.timeout)
+                return True
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+                return False
+
+        with self._lock:
+            try:
+                self._queue.put_nowait(event)
+                return True
+            except queue.Full:
+                self.dropped += 1
+                if self.policy == 'drop_newest':
+                    return False
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+                self._queue.put_nowait(event)
+                return True
+
+    def get(self, timeout=None):
+        """wait up to `timeout` seconds for the next event, None if none
+        came"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def drain(self, limit=None):
+        """return the queued events without blocking, oldest first"""
+        events = []
+        while limit is None or len(events) < limit:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+
+class SeenSet:
+    """The last `capacity` message sids, to drop webhooks twilio retried.
+    Only the sids' hashes are kept, in a set with a ring buffer evicting
+    the oldest, so memory stays flat however long the app runs. The
+    history table's unique sid index catches anything older."""
+
+    def __init__(self, capacity=10000, sids=()):
+        self._hashes = set()
+        self._order = collections.deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        for sid in sids:
+            self.add(sid)
+
+    def add(self, sid):
+        """remember a sid, returns False if it was seen already"""
+        key = hash(sid)
+        with self._lock:
+            if key in self._hashes:
+                return False
+            if len(self._order) == self._order.maxlen:
+                self._hashes.discard(self._order[0])
+            self._order.append(key)
+            self._hashes.add(key)
+            return True
+
+
+class Resequencer:
+    """Puts each channel's messages back in twilio index order.
+
+    A message is released as soon as it is the next index of its channel.
+    One that arrives ahead of a gap is held back until the gap is filled,
+    or for at most `window` seconds, after which the held messages are
+    released in order and the missing ones are shown whenever they come.
+    `next_index` seeds the next expected index per channel, a channel
+    without one is expected to start at 0 like it does on twilio, so the
+    first message seen of a channel with older messages waits out the
+    window too. Messages without an index, like member events, are never
+    held.
+    """
+
+    def __init__(self, window=1.0, next_index=None):
+        self.window = window
+        self.next_index = dict(next_index or {})
+        self._held = {}  # channel -> heap of (index, deadline, n, message)
+        self._count = itertools.count()  # ties, messages don't compare
+
+    def __len__(self):
+        return sum(len(held) for held in self._held.values())
+
+    def release(self, messages=(), now=None):
+        """add `messages` and return every message ready to be shown"""
+        now = time.monotonic() if now is None else now
+        ready = []
+        for message in messages:
+            channel, index = message.channel, message.index
+            expected = self.next_index.get(channel, 0)
+            if index is None or index < expected:
+                ready.append(message)  # no index, or too late to hold back
+            elif index == expected:
+                ready.append(message)
+                self.next_index[channel] = index + 1
+                self._release_run(channel, ready)
+            else:
+                heapq.heappush(self._held.setdefault(channel, []),
+                               (index, now + self.window, next(self._count),
+                                message))
+        for channel in list(self._held):
+            held = self._held.get(channel)
+            while held and min(entry[1] for entry in held) <= now:
+                # waited long enough, skip the gap before the first one held
+                self.next_index[channel] = held[0][0]
+                self._release_run(channel, ready)
+        return ready
+
+    def _release_run(self, channel, ready):
+        """release the held messages that follow on from next_index"""
+        held = self._held.get(channel)
+        while held and held[0][0] <= self.next_index[channel]:
+            index, _, _, message = heapq.heappop(held)
+            ready.append(message)
+            self.next_index[channel] = max(self.next_index[channel], index + 1)
+        if not held:
+            self._held.pop(channel, None)
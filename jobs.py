@@ -0,0 +1,146 @@
+"""bulk api work run in the background on a bounded worker pool"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RateLimiter:
+    """Spaces calls out to at most `rate` per second across threads.
+    pause() holds every caller back, e.g. after the api answered 429."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+def status_code(error):
+    """http status of a TwilioRestException or a requests error"""
+    status = getattr(error, 'status', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code',
+                         None)
+    return status
+
+
+class BulkJob:
+    """Runs `func(item)` for each item on `workers` threads, at most `rate`
+    calls per second.
+
+    A call answered with 429 pauses the whole job for `backoff` seconds
+    (doubling on every retry) and is retried up to `retries` times, any
+    other error fails the item. Progress goes to `report(text)` at most
+    once per `progress_interval` seconds, or item by item with
+    `report_each`, followed by a summary of what succeeded and what failed.
+    cancel() skips the items not started yet.
+    """
+
+    def __init__(self, name, func, items, describe=str, workers=8, rate=10,
+                 retries=3, backoff=1.0, report=print,
+                 progress_interval=1.0, report_each=False):
+        self.name = name
+        self.func = func
+        self.items = items
+        self.describe = describe
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.report = report
+        self.progress_interval = progress_interval
+        self.report_each = report_each
+        self.limiter = RateLimiter(rate)
+        self.succeeded = []
+        self.failed = []
+        self.skipped = 0
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._reported_at = time.monotonic()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._thread = threading.Thread(name=f'job_{self.name}',
+                                        target=self._run, daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def _run(self):
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                # items may be a generator listing them lazily, so this is
+                # iterated here rather than on the caller's thread
+                for item in self.items:
+                    if self._cancelled.is_set():
+                        break
+                    pool.submit(self._do, item)
+        except Exception as e:
+            self.report(f"{self.name}: {e}")
+        self.report(self.summary())
+
+    def _do(self, item):
+        if self._cancelled.is_set():
+            with self._lock:
+                self.skipped += 1
+            return
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            try:
+                self.func(item)
+            except Exception as e:
+                if status_code(e) == 429 and attempt < self.retries:
+                    self.limiter.pause(self.backoff * 2 ** attempt)
+                    continue
+                self._done(self.failed, (item, e))
+            else:
+                self._done(self.succeeded, item)
+            return
+
+    def _done(self, results, result):
+        if self.report_each:
+            with self._lock:
+                results.append(result)
+            if results is self.failed:
+                item, error = result
+                self.report(f"{self.name}: {self.describe(item)} failed: "
+                            f"{getattr(error, 'msg', error)}")
+            else:
+                self.report(f"{self.name}: {self.describe(result)} done")
+            return
+        with self._lock:
+            results.append(result)
+            now = time.monotonic()
+            if now - self._reported_at < self.progress_interval:
+                return
+            self._reported_at = now
+            progress = f"{self.name}: {len(self.succeeded)} done, " \
+                       f"{len(self.failed)} failed"
+        self.report(progress)
+
+    def summary(self):
+        text = f"{self.name} {'cancelled' if self._cancelled.is_set() else 'done'}: " \
+               f"{len(self.succeeded)} succeeded, {len(self.failed)} failed"
+        if self.skipped:
+            text += f", {self.skipped} skipped"
+        if self.report_each:
+            return text  # failures were reported as they happened
+        for item, error in self.failed:
+            text += f"\n  {self.describe(item)}: {getattr(error, 'msg', error)}"
+        return text
@@ -0,0 +1,100 @@
+"""chat messages, from the webhook to storage and the screen"""
+
+import calendar
+import json
+import time
+from urllib.parse import parse_qs
+
+from utils import ansi_bold, ansi_italics, ansi_end
+
+MESSAGE = 'onMessageSent'
+MEMBER_EVENTS = ('onMemberAdded', 'onMemberRemoved')
+ERROR = 'error'
+
+
+class Message:
+    """A webhook event with its fields kept as they arrived.
+    `created` is the epoch timestamp in seconds, `id` the history id once
+    the message has been stored and `received` the perf_counter() time
+    the webhook came in. Formatting only happens in render()."""
+
+    __slots__ = ('event', 'channel', 'sender', 'body', 'created', 'sid',
+                 'index', 'id', 'received')
+
+    def __init__(self, event, channel, sender, body, created=0, sid=None,
+                 index=None, id=None):
+        self.event = event
+        self.channel = channel
+        self.sender = sender
+        self.body = body
+        self.created = created
+        self.sid = sid
+        self.index = index
+        self.id = id
+        self.received = None
+
+    def __repr__(self):
+        return f"Message({self.event!r}, {self.channel!r}, " \
+               f"{self.sender!r}, {self.body!r})"
+
+    @classmethod
+    def from_row(cls, row):
+        """message from a history table row"""
+        id, sid, channel, index, sender, body, created = row
+        return cls(MESSAGE, channel, sender, body, created, sid, index, id)
+
+    def to_row(self):
+        return (self.id, self.sid, self.channel, self.index, self.sender,
+                self.body, self.created)
+
+    @classmethod
+    def from_json(cls, line):
+        """message relayed by the relay hub"""
+        return cls(*json.loads(line))
+
+    def to_json(self):
+        return json.dumps([self.event, self.channel, self.sender, self.body,
+                           self.created, self.sid, self.index])
+
+
+def parse_timestamp(value):
+    """'2020-04-29T06:39:12.123Z' to epoch seconds, without strptime"""
+    return calendar.timegm((int(value[0:4]), int(value[5:7]),
+                            int(value[8:10]), int(value[11:13]),
+                            int(value[14:16]), int(value[17:19]), 0, 0, 0))
+
+
+def parse_webhook(query):
+    """receives the query string of a webhook request sent when actions
+    happen on the chat client and returns it as a Message"""
+    params = parse_qs(query)
+    event = params.get('EventType', [MESSAGE])[0]
+    channel = params.get('ChannelSid', [None])[0]
+    try:
+        if event in MEMBER_EVENTS:
+            return Message(event, channel, params['Identity'][0],
+                           params['Reason'][0])
+        index = params.get('Index')
+        return Message(MESSAGE, channel, params['From'][0],
+                       params['Body'][0],
+                       parse_timestamp(params['DateCreated'][0]),
+                       params.get('MessageSid', [None])[0],
+                       int(index[0]) if index else None)
+    except KeyError as e:
+        return Message(ERROR, channel, None,
+                       f"Failed to parse response: {e}")
+    except Exception as e:
+        return Message(ERROR, channel, None, f"An error occurred: {e}")
+
+
+def render(message, mark=None):
+    """formatted text to show for a message, `mark` can mark up the body"""
+    if message.event == MESSAGE:
+        created = time.gmtime(message.created)
+        body = mark(message.body) if mark else message.body
+        return f"{created.tm_hour:02d}:{created.tm_min:02d} " \
+               f"{ansi_bold}{message.sender}{ansi_end}  {body}"
+    if message.event in MEMBER_EVENTS:
+        return f"{ansi_italics}{message.sender} " \
+               f"{message.body.lower()}{ansi_end}"
+    return message.body
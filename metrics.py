@@ -0,0 +1,243 @@
+"""counters and timers for the hot paths, exposed in the prometheus text
+format on the webhook server's /metrics path, plus an on-demand profiler"""
+
+import collections
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                   1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# metric families, name -> {labels: metric}, so that every labelled child
+# of a metric is rendered in one group like the text format requires
+_registry = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def _labels_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Gauge:
+    """a value that is set, or read from `fn` when the metrics are scraped"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels, fn=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, self.labels, self.fn() if self.fn else self.value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def samples(self):
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        cumulative = 0
+        for bound, bucket in zip(self.buckets, counts):
+            cumulative += bucket
+            yield f'{self.name}_bucket', self.labels + (('le', bound),), \
+                cumulative
+        yield f'{self.name}_bucket', self.labels + (('le', '+Inf'),), count
+        yield f'{self.name}_sum', self.labels, total
+        yield f'{self.name}_count', self.labels, count
+
+
+def _get(cls, name, help, labels, **kwargs):
+    labels = tuple(sorted(labels.items()))
+    with _lock:
+        family = _registry.setdefault(name, {})
+        metric = family.get(labels)
+        if metric is None:
+            metric = family[labels] = cls(name, help, labels, **kwargs)
+    return metric
+
+
+def counter(name, help='', **labels):
+    return _get(Counter, name, help, labels)
+
+
+def histogram(name, help='', buckets=LATENCY_BUCKETS, **labels):
+    return _get(Histogram, name, help, labels, buckets=buckets)
+
+
+def gauge(name, help='', fn=None, **labels):
+    metric = _get(Gauge, name, help, labels)
+    if fn is not None:
+        metric.fn = fn
+    return metric
+
+
+@contextmanager
+def twilio_call(call):
+    """time a twilio api call and count its errors"""
+    counter('cchat_twilio_requests_total', 'Twilio API calls made',
+            call=call).inc()
+    try:
+        with histogram('cchat_twilio_request_seconds',
+                       'Twilio API call latency', call=call).time():
+            yield
+    except Exception:
+        counter('cchat_twilio_errors_total', 'Twilio API calls that failed',
+                call=call).inc()
+        raise
+
+
+def render():
+    """all metrics in the prometheus text exposition format"""
+    out = io.StringIO()
+    with _lock:
+        families = [list(family.values()) for family in _registry.values()]
+    for family in families:
+        first = family[0]
+        out.write(f'# HELP {first.name} {first.help}\n')
+        out.write(f'# TYPE {first.name} {first.kind}\n')
+        for metric in family:
+            for name, labels, value in metric.samples():
+                out.write(f'{name}{_labels_text(labels)} {value}\n')
+    return out.getvalue()
+
+
+class SamplingProfiler:
+    """Samples the stacks of every thread every `interval` seconds.
+    Unlike cProfile, which only sees the thread it was started on, this
+    also covers the webhook, writer and worker threads."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(name='sampling_profiler',
+                                        target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} '
+                                 f'({code.co_filename}:{frame.f_lineno})')
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def report(self, path, top=15):
+        """write collapsed stacks (flamegraph input) to `path` and return
+        the functions seen most often at the top of a stack"""
+        leaves = collections.Counter()
+        with open(path, 'w') as out:
+            for stack, count in self.stacks.most_common():
+                out.write(f'{stack} {count}\n')
+                leaves[stack.rsplit(';', 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        lines = [f'{count * 100 / total:5.1f}% {leaf}'
+                 for leaf, count in leaves.most_common(top)]
+        return '\n'.join(lines)
+
+
+_profiler = None
+
+
+def start_profile(mode='cprofile'):
+    global _profiler
+    if _profiler is not None:
+        return "Error: profiler is already running"
+    if mode == 'cprofile':
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    elif mode == 'sample':
+        _profiler = SamplingProfiler()
+        _profiler.start()
+    else:
+        return "Error: profiler mode is cprofile or sample"
+    return f"{mode} profiler started, /profile stop to see the results"
+
+
+def stop_profile(path=None):
+    global _profiler
+    if _profiler is None:
+        return "Error: profiler is not running"
+    profiler, _profiler = _profiler, None
+    if isinstance(profiler, SamplingProfiler):
+        profiler.stop()
+        path = path or 'cchat.stacks'
+        return f"{profiler.report(path)}\nstacks saved to {path}"
+    profiler.disable()
+    path = path or 'cchat.prof'
+    profiler.dump_stats(path)
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative') \
+        .print_stats(15)
+    return f"{out.getvalue().strip()}\nprofile saved to {path}"
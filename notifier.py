@@ -0,0 +1,78 @@
+"""desktop notifications, off the ingest path"""
+
+import collections
+import queue
+import threading
+import time
+
+import metrics
+
+notify_time = metrics.histogram('cchat_notify_seconds',
+                                'Time spent showing desktop notifications')
+mentions_total = metrics.counter('cchat_mentions_total',
+                                 'Mentions queued for a notification')
+
+
+class Notifier:
+    """Shows desktop notifications from a worker thread.
+
+    mention() only queues the channel name, so the ingest path never
+    waits on D-Bus. Mentions arriving within `window` seconds of the
+    first one are shown as one summary, like "5 mentions in #ops,
+    #general", and notifications are at least `min_interval` seconds
+    apart.
+    """
+
+    def __init__(self, window=2.0, min_interval=5.0, timeout=5000):
+        self.window = window
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._shown_at = float('-inf')
+        self._notification = None
+        threading.Thread(name='notifier', target=self._run,
+                         daemon=True).start()
+
+    def mention(self, channel_name):
+        mentions_total.inc()
+        self._queue.put(channel_name)
+
+    def _run(self):
+        while True:
+            mentions = collections.Counter([self._queue.get()])
+            deadline = max(time.monotonic() + self.window,
+                           self._shown_at + self.min_interval)
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    mentions[self._queue.get(timeout=timeout)] += 1
+                except queue.Empty:
+                    break
+            with notify_time.time():
+                self._show(summary(mentions))
+            self._shown_at = time.monotonic()
+
+    def _show(self, text):
+        try:
+            if self._notification is None:
+                import notify2
+                notify2.init("cchat")
+                self._notification = notify2.Notification(None)
+                self._notification.set_urgency(notify2.URGENCY_NORMAL)
+                self._notification.set_timeout(self.timeout)
+            self._notification.update('cchat', text)
+            self._notification.show()
+        except Exception:
+            # no notification daemon, try again on the next mention
+            self._notification = None
+
+
+def summary(mentions):
+    """notification text for a Counter of mentions per channel name"""
+    total = sum(mentions.values())
+    channels = ', '.join(f'#{name}' for name in mentions)
+    if total == 1:
+        return f"You've been mentioned on {channels}"
+    return f"{total} mentions in {channels}"
@@ -0,0 +1,75 @@
+"""background delivery of outgoing chat messages"""
+
+import itertools
+import queue
+import threading
+import time
+
+import requests
+
+SENT = 'sent'
+FAILED = 'failed'
+
+
+class Outbox:
+    """Sends chat messages on worker threads so the ui never waits on the api.
+
+    `send(channel, body)` does the actual request and raises on failure,
+    anything it raises fails the message.
+    A channel is always handled by the same worker, so its messages go out
+    in the order they were written. Connection errors, 429s and 5xx
+    responses are retried up to `retries` times with exponential backoff
+    capped at `max_backoff` seconds.
+
+    A message is pending until `on_status(key, status, error)` is called
+    from the worker thread with SENT or FAILED.
+    """
+
+    def __init__(self, send, workers=2, retries=3, backoff=0.5,
+                 max_backoff=8.0, on_status=None):
+        self._send = send
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_status = on_status
+        self._keys = itertools.count(1)
+        self._queues = [queue.Queue() for _ in range(workers)]
+        for number, jobs in enumerate(self._queues):
+            threading.Thread(name=f'outbox_{number}', target=self._work,
+                             args=(jobs,), daemon=True).start()
+
+    def send(self, channel, body):
+        """queue a message, returns the key its status is reported under"""
+        key = f'out-{next(self._keys)}'
+        jobs = self._queues[hash(channel) % len(self._queues)]
+        jobs.put((key, channel, body))
+        return key
+
+    def _status(self, key, status, error=None):
+        if self.on_status is not None:
+            self.on_status(key, status, error)
+
+    def _work(self, jobs):
+        while True:
+            key, channel, body = jobs.get()
+            for attempt in itertools.count():
+                try:
+                    self._send(channel, body)
+                except Exception as e:
+                    if attempt >= self.retries or not _retryable(e):
+                        self._status(key, FAILED, e)
+                        break
+                    time.sleep(min(self.max_backoff,
+                                   self.backoff * 2 ** attempt))
+                else:
+                    self._status(key, SENT)
+                    break
+
+
+def _retryable(error):
+    if not isinstance(error, requests.RequestException):
+        return False
+    response = getattr(error, 'response', None)
+    if response is None:  # connection error or timeout
+        return True
+    return response.status_code == 429 or response.status_code >= 500
@@ -0,0 +1,229 @@
+"""relay hub, receives the twilio webhook once and fans the events out to
+any number of cchat clients
+
+    python relay.py
+
+Clients connect over a unix socket or tcp, send the channel sids they
+want as a JSON line ({"channels": [...]}, again whenever that changes)
+and then read one JSON line per event. Point cchat at the hub with
+`relay = unix:PATH` or `relay = HOST:PORT` under [server].
+"""
+
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+import metrics
+import utils
+from capture import Capture
+from ingest import EventQueue, SeenSet
+from message import Message
+from server import make_server
+
+
+def parse_address(address):
+    """'unix:PATH' or 'HOST:PORT' to a socket family and address"""
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[5:]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or 'localhost', int(port))
+
+
+class Subscriber:
+    """a connected client, the channels it wants and the events waiting to
+    be sent to it"""
+
+    def __init__(self, channels=None, queue_size=1000):
+        self.channels = channels  # None for every channel
+        self.events = EventQueue(queue_size, 'drop_oldest')
+
+    def wants(self, message):
+        # errors aren't tied to a channel, everyone gets them
+        return self.channels is None or message.channel is None or \
+            message.channel in self.channels
+
+
+class Relay:
+    """Fans webhook events out to the subscribers.
+
+    It stands in for the EventQueue the webhook server puts events on.
+    Every subscriber has its own bounded queue drained by its own thread,
+    so a slow one only loses its own oldest events and never holds up the
+    webhook or the other subscribers.
+    """
+
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self.subscribers = ()  # replaced, not changed, so put() needn't lock
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(subscriber.events) for subscriber in self.subscribers)
+
+    @property
+    def dropped(self):
+        return self._dropped + sum(subscriber.events.dropped
+                                   for subscriber in self.subscribers)
+
+    def subscribe(self, channels=None):
+        subscriber = Subscriber(channels, self.queue_size)
+        with self._lock:
+            self.subscribers += (subscriber,)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers = tuple(other for other in self.subscribers
+                                     if other is not subscriber)
+            self._dropped += subscriber.events.dropped
+
+    def put(self, message):
+        for subscriber in self.subscribers:
+            if subscriber.wants(message):
+                subscriber.events.put(message)
+        return True
+
+
+def _channels(line):
+    channels = json.loads(line).get('channels')
+    return None if channels is None else frozenset(channels)
+
+
+class RelayHandler(socketserver.StreamRequestHandler):
+    """one subscribed client, events are written on this thread and channel
+    filter updates read on another"""
+
+    def handle(self):
+        try:
+            channels = _channels(self.rfile.readline())
+        except ValueError:
+            return
+        subscriber = self.server.relay.subscribe(channels)
+        closed = threading.Event()
+        threading.Thread(name='relay_reader', target=self._read,
+                         args=(subscriber, closed), daemon=True).start()
+        try:
+            while not closed.is_set():
+                message = subscriber.events.get(timeout=1)
+                if message is None:
+                    continue
+                batch = [message] + subscriber.events.drain()
+                self.wfile.write(''.join(message.to_json() + '\n'
+                                         for message in batch).encode())
+        except OSError:
+            pass  # client went away
+        finally:
+            self.server.relay.unsubscribe(subscriber)
+
+    def _read(self, subscriber, closed):
+        try:
+            for line in self.rfile:
+                subscriber.channels = _channels(line)
+        except (OSError, ValueError):
+            pass
+        closed.set()
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+
+
+def relay_server(relay, address):
+    """server for subscribers on `address`, serve_forever() to start it"""
+    family, address = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            os.unlink(address)  # left over from a hub that didn't exit cleanly
+        server = socketserver.ThreadingUnixStreamServer(address, RelayHandler)
+    else:
+        server = _TCPServer(address, RelayHandler)
+    server.daemon_threads = True
+    server.relay = relay
+    metrics.gauge('cchat_relay_subscribers', 'Clients subscribed to the relay',
+                  fn=lambda: len(relay.subscribers))
+    return server
+
+
+class RelayClient:
+    """Puts the events from a relay hub on `events`, like the webhook
+    server does, reconnecting with backoff when the hub goes away.
+    Every event is received until subscribe() narrows it to some channels.
+    """
+
+    def __init__(self, address, events, on_error=None, max_backoff=30.0):
+        self.family, self.address = parse_address(address)
+        self.events = events
+        self.on_error = on_error
+        self.max_backoff = max_backoff
+        self.channels = None
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, channels):
+        with self._lock:
+            self.channels = list(channels)
+            if self._sock is not None:
+                self._send_channels()
+
+    def _send_channels(self):
+        line = json.dumps({'channels': self.channels}) + '\n'
+        try:
+            self._sock.sendall(line.encode())
+        except OSError:
+            pass  # sent again on reconnect
+
+    def run(self):
+        backoff = 1.0
+        while True:
+            try:
+                with socket.socket(self.family, socket.SOCK_STREAM) as sock:
+                    sock.connect(self.address)
+                    with self._lock:
+                        self._sock = sock
+                        self._send_channels()
+                    backoff = 1.0
+                    for line in sock.makefile('rb'):
+                        message = Message.from_json(line)
+                        message.received = time.perf_counter()
+                        self.events.put(message)
+                error = 'relay closed the connection'
+            except (OSError, ValueError) as e:
+                error = f'relay: {e}'
+            finally:
+                with self._lock:
+                    self._sock = None
+            if self.on_error is not None:
+                self.on_error(f"{error}, reconnecting in {backoff:.0f}s")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+
+def main():
+    relay = Relay(
+        queue_size=utils.config.getint('relay', 'queue_size', fallback=1000))
+    listen = utils.config.get('relay', 'listen',
+                              fallback='unix:.cchat_relay.sock')
+    hub = relay_server(relay, listen)
+    threading.Thread(name='relay_hub', target=hub.serve_forever,
+                     daemon=True).start()
+    port = utils.config.getint('relay', 'webhook_port', fallback=8000)
+    print(f"relaying webhooks on port {port} to {listen}")
+    capture_path = utils.config.get('relay', 'capture', fallback=None)
+    capture = Capture(capture_path) if capture_path else None
+    try:
+        make_server(relay, port=port, capture=capture, seen=SeenSet(),
+                    backlog=utils.config.getint('relay', 'backlog',
+                                                fallback=128)).serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if capture is not None:
+            capture.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""webhook server, receives twilio chat events and queues them"""
+
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+import metrics
+from message import parse_webhook
+
+webhooks = metrics.counter('cchat_webhooks_total', 'Webhook requests received')
+duplicates = metrics.counter('cchat_webhooks_duplicate_total',
+                             'Webhook requests dropped as retries')
+parse_time = metrics.histogram('cchat_webhook_parse_seconds',
+                               'Time spent parsing webhook requests')
+
+
+class ChatServer(BaseHTTPRequestHandler, ):
+    def _set_headers(self):
+        self.send_response(200)
+        self.send_header("Content-type", "text/html")
+        self.end_headers()
+
+    def _html(self, params):
+        """Shows the url params on the browser in html.
+            Nothing useful. Just for debugging
+            """
+        content = f"<html><body><p>{params}</p></body></html>"
+        return content.encode("utf8")
+
+    def do_GET(self):
+        received = time.perf_counter()
+        url = urlsplit(self.path)
+        if url.path == '/metrics':
+            return self._metrics()
+        # acknowledge straight away so twilio doesn't time out and retry,
+        # whatever consumes the queue (the ui, or a headless sink when
+        # benchmarking) picks the event up from there
+        self._set_headers()
+        self.wfile.write(self._html(url.query))
+        webhooks.inc()
+        if self.server.capture is not None:
+            self.server.capture.record(url.query)
+        with parse_time.time():
+            message = parse_webhook(url.query)
+        if message.sid is not None and self.server.seen is not None and \
+                not self.server.seen.add(message.sid):
+            duplicates.inc()  # twilio retried a request we already had
+            return
+        message.received = received
+        self.server.events.put(message)
+
+    def _metrics(self):
+        body = metrics.render().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """suppress logs"""
+        return
+
+
+def make_server(events, server_class=ThreadingHTTPServer,
+                handler_class=ChatServer,
+                addr="localhost",
+                port=8000,
+                capture=None,
+                seen=None,
+                backlog=128):
+    """webhook server putting parsed events on `events`,
+    each request is handled on its own thread. Raw requests are also
+    recorded to `capture` if given, see capture.Capture, and messages
+    whose sid is already in the ingest.SeenSet `seen` are dropped.
+    `backlog` connections can wait to be accepted, enough for a burst of
+    webhooks not to be refused and retried by the client a second later."""
+    server_address = (addr, port)
+    httpd = server_class(server_address, handler_class,
+                         bind_and_activate=False)
+    httpd.request_queue_size = backlog  # listen() is called with it
+    try:
+        httpd.server_bind()
+        httpd.server_activate()
+    except BaseException:
+        httpd.server_close()
+        raise
+    httpd.daemon_threads = True
+    httpd.events = events
+    httpd.capture = capture
+    httpd.seen = seen
+    metrics.gauge('cchat_event_queue_depth',
+                  'Webhook events waiting to be handled', fn=lambda: len(events))
+    metrics.gauge('cchat_events_dropped',
+                  'Webhook events dropped because the queue was full',
+                  fn=lambda: events.dropped)
+    return httpd
+
+
+def chat_server(events, **kwargs):
+    make_server(events, **kwargs).serve_forever()
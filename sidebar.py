@@ -0,0 +1,204 @@
+"""channel list for the sidebar, sized for services with thousands of
+channels"""
+
+from bisect import bisect_left, insort
+
+from prompt_toolkit.application import get_app
+from prompt_toolkit.data_structures import Point
+from prompt_toolkit.formatted_text import to_formatted_text
+from prompt_toolkit.key_binding import KeyBindings
+from prompt_toolkit.layout.controls import UIContent, UIControl
+from prompt_toolkit.mouse_events import MouseEventType
+
+
+class ChannelList(UIControl):
+    """Selectable list of channels, `pinned` first and the rest by name.
+
+    Only the rows that fit on screen are drawn, with their labels made
+    by `label(sid)` when drawn, so nothing is rebuilt when a channel's
+    unread count changes. update() applies the channels added and removed
+    since the last call. The names are also kept in a sorted index, so
+    typing filters the list down to the channels starting with what was
+    typed with two bisects, backspace and escape undo the filter.
+
+    `current` is the channel shown, enter or a click makes the selected
+    row current and calls `on_select(sid)`.
+    """
+
+    def __init__(self, channels=(), pinned=None, label=None, on_select=None):
+        self.names = {}    # sid -> name
+        self._index = []   # sorted (lowercase name, sid), without pinned
+        self.pinned = pinned
+        self.label = label or self.names.get
+        self.on_select = on_select
+        self.current = pinned
+        self.selected = pinned
+        self.filter = ''
+        self._bindings = self._key_bindings()
+        self.update(channels)
+
+    @property
+    def title(self):
+        return f"channels /{self.filter}" if self.filter else "channels"
+
+    def update(self, channels):
+        """make (sid, name) channels the listed ones, changing only what
+        differs from the list shown"""
+        channels = dict(channels)
+        for sid in [sid for sid in self.names if sid not in channels]:
+            self.remove(sid)
+        for sid, name in channels.items():
+            if self.names.get(sid) != name:
+                self.add(sid, name)
+
+    def add(self, sid, name):
+        if sid in self.names:
+            self.remove(sid)
+        self.names[sid] = name
+        if sid != self.pinned:
+            insort(self._index, (name.lower(), sid))
+
+    def remove(self, sid):
+        name = self.names.pop(sid, None)
+        if name is None:
+            return
+        if sid != self.pinned:
+            i = bisect_left(self._index, (name.lower(), sid))
+            del self._index[i]
+        if sid == self.selected:
+            self.selected = self.current if sid != self.current else None
+
+    # rows are the pinned channel, if it is listed and matches the filter,
+    # followed by the slice of the index matching the filter
+
+    def _rows(self):
+        """(start, end) of the index slice shown and if pinned is shown"""
+        show_pinned = self.pinned in self.names and \
+            self.names[self.pinned].lower().startswith(self.filter)
+        if not self.filter:
+            return 0, len(self._index), show_pinned
+        return (bisect_left(self._index, (self.filter,)),
+                bisect_left(self._index, (self.filter + '\uffff',)),
+                show_pinned)
+
+    def _sid(self, row, rows):
+        start, _, show_pinned = rows
+        if show_pinned:
+            if row == 0:
+                return self.pinned
+            row -= 1
+        return self._index[start + row][1]
+
+    def _row(self, sid, rows):
+        """row of a channel, None if it isn't shown"""
+        start, end, show_pinned = rows
+        if sid is None or sid not in self.names:
+            return None
+        if sid == self.pinned:
+            return 0 if show_pinned else None
+        i = bisect_left(self._index, (self.names[sid].lower(), sid))
+        if not start <= i < end:
+            return None
+        return i - start + show_pinned
+
+    def _count(self, rows):
+        start, end, show_pinned = rows
+        return end - start + show_pinned
+
+    def preferred_width(self, max_available_width):
+        return None
+
+    def is_focusable(self):
+        return True
+
+    def create_content(self, width, height):
+        rows = self._rows()
+        selected = self._row(self.selected, rows) or 0
+        focused = get_app().layout.current_control is self
+
+        def get_line(row):
+            # only called for the rows on screen
+            sid = self._sid(row, rows)
+            style = 'reverse' if focused and row == selected else ''
+            marker = '> ' if sid == self.current else '  '
+            return [(style, marker)] + \
+                to_formatted_text(self.label(sid), style=style)
+
+        return UIContent(get_line=get_line, line_count=self._count(rows),
+                         cursor_position=Point(x=0, y=selected),
+                         show_cursor=False)
+
+    def _move(self, step):
+        rows = self._rows()
+        count = self._count(rows)
+        if count:
+            row = self._row(self.selected, rows)
+            row = 0 if row is None else max(0, min(count - 1, row + step))
+            self.selected = self._sid(row, rows)
+
+    def _select(self):
+        rows = self._rows()
+        if self._row(self.selected, rows) is None:
+            if not self._count(rows):
+                return
+            self.selected = self._sid(0, rows)
+        self.filter = ''
+        if self.selected != self.current and self.on_select is not None:
+            self.on_select(self.selected)
+
+    def _set_filter(self, text):
+        self.filter = text
+        rows = self._rows()
+        if self._row(self.selected, rows) is None and self._count(rows):
+            self.selected = self._sid(0, rows)
+
+    def get_key_bindings(self):
+        return self._bindings
+
+    def _key_bindings(self):
+        bindings = KeyBindings()
+
+        @bindings.add('up')
+        def _(event):
+            self._move(-1)
+
+        @bindings.add('down')
+        def _(event):
+            self._move(1)
+
+        @bindings.add('home')
+        def _(event):
+            self._move(-self._count(self._rows()))
+
+        @bindings.add('end')
+        def _(event):
+            self._move(self._count(self._rows()))
+
+        @bindings.add('enter')
+        @bindings.add(' ')
+        def _(event):
+            self._select()
+
+        @bindings.add('backspace')
+        def _(event):
+            self._set_filter(self.filter[:-1])
+
+        @bindings.add('escape')
+        def _(event):
+            self._set_filter('')
+
+        @bindings.add('<any>')
+        def _(event):
+            if event.data.isprintable():
+                self._set_filter(self.filter + event.data.lower())
+
+        return bindings
+
+    def mouse_handler(self, mouse_event):
+        if mouse_event.event_type == MouseEventType.MOUSE_UP:
+            rows = self._rows()
+            if mouse_event.position.y < self._count(rows):
+                self.selected = self._sid(mouse_event.position.y, rows)
+                self._select()
+                return None
+        return NotImplemented
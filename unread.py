@@ -0,0 +1,38 @@
+"""unread message counts per channel"""
+
+
+class UnreadCounters:
+    """Unread counts and last activity per channel, kept in memory and
+    updated in O(1) as messages come in instead of being counted from
+    history on every redraw. Reading a channel persists the newest message
+    id seen in it as its last read message, which is where the counts
+    start from on the next run."""
+
+    def __init__(self, history):
+        self.history = history
+        self.counts = {}
+        self.last_activity = {}
+        self.newest_id = {}
+        for channel, (count, created, last_id) in history.unread().items():
+            self.counts[channel] = count
+            self.last_activity[channel] = created
+            self.newest_id[channel] = last_id
+
+    def add(self, message, read=False):
+        """count a stored message, `read` if its channel is being shown"""
+        channel = message.channel
+        self.newest_id[channel] = message.id
+        # backfilled messages can be older than the last one seen
+        self.last_activity[channel] = max(
+            message.created, self.last_activity.get(channel) or 0)
+        if not read:
+            self.counts[channel] = self.counts.get(channel, 0) + 1
+
+    def mark_read(self, channel):
+        self.counts.pop(channel, None)
+        newest_id = self.newest_id.get(channel)
+        if newest_id is not None:
+            self.history.mark_read(channel, newest_id)
+
+    def count(self, channel):
+        return self.counts.get(channel, 0)
@@ -3,13 +3,16 @@
 import os
 import sys
 import re
+import time
+import threading
 import requests
 import configparser
 
 from halo import Halo
-from twilio.rest import Client
 from twilio.base.exceptions import TwilioRestException
-from authy.api import AuthyApiClient
+
+import metrics
+from jobs import BulkJob
 
 config = configparser.ConfigParser()
 config.read('.cchat.cfg')
@@ -21,38 +24,93 @@ chat_service_sid = os.getenv('CHAT_SERVICE_SID')
 sms_service_sid = os.getenv('SMS_SERVICE_SID')
 auth_token = os.getenv('AUTH_TOKEN')
 authy_key = os.getenv('AUTHY_API_KEY')
+# the chat api, can be pointed at a local stand-in (bench/fake_twilio.py)
+chat_url = os.getenv('TWILIO_CHAT_URL', 'https://chat.twilio.com')
 
 ansi_red = '\033[0;31m'
 ansi_bold = '\033[1m'
 ansi_italics = '\033[3m'
 ansi_end = '\033[0m'
 
-if not any((account_sid, sms_service_sid, chat_service_sid, auth_token, authy_key)):
-    spinner.fail("One or more Twilio credentials not set. "
-                 "Please check your .env file")
-    sys.exit()
-else:
-    spinner.succeed("twilio credentials set")
-
-client = Client(account_sid, auth_token)
-authy_api = AuthyApiClient(authy_key)
-
-spinner.start("checking user credentials ...")
-try:
-    authy_id = config['user']['authy_id']
-    authy_token = config['user']['authy_token']
-    status = authy_api.users.status(authy_id)
+identity = config.get('user', 'identity', fallback=None)
+
+_client = None
+_authy = None
+
+
+def twilio_client():
+    """twilio rest client, imported and created on first use"""
+    global _client
+    if _client is None:
+        from twilio.rest import Client
+        _client = Client(account_sid, auth_token)
+        _client.chat.base_url = chat_url
+    return _client
+
+
+def authy_client():
+    """authy api client, imported and created on first use"""
+    global _authy
+    if _authy is None:
+        from authy.api import AuthyApiClient
+        _authy = AuthyApiClient(authy_key)
+    return _authy
+
+
+def save_config():
+    with open('.cchat.cfg', 'w+') as configfile:
+        config.write(configfile)
+
+
+def login():
+    """check credentials and log the user in, registering new users"""
+    global identity
+    if not any((account_sid, sms_service_sid, chat_service_sid, auth_token, authy_key)):
+        spinner.fail("One or more Twilio credentials not set. "
+                     "Please check your .env file")
+        sys.exit()
+    else:
+        spinner.succeed("twilio credentials set")
+
+    spinner.start("checking user credentials ...")
+    try:
+        authy_id = config['user']['authy_id']
+        identity = config['user']['identity']
+    except KeyError:
+        identity = register()
+        return
+
+    # fetch channels while authy is checked, the interface doesn't wait
+    # for them to be loaded
+    channel_directory.refresh_in_background()
+    check_authy(authy_id)
+    spinner.succeed(f"logged in as {identity}")
+
+
+def check_authy(authy_id):
+    """authy status check, skipped if one passed less than
+    [cache] authy_ttl seconds ago"""
+    ttl = config.getint('cache', 'authy_ttl', fallback=86400)
+    verified_at = config.getfloat('user', 'verified_at', fallback=0)
+    if time.time() - verified_at < ttl:
+        spinner.succeed("authy verified")
+        return
+    status = authy_client().users.status(authy_id)
     if status.ok():
+        config['user']['verified_at'] = str(int(time.time()))
+        save_config()
         spinner.succeed("authy verified")
     else:
         spinner.fail(f"authy verification failed: {status.errors()}")
         sys.exit()
-    identity = config['user']['identity']
-    spinner.succeed(f"logged in as {identity}")
-except (KeyError, TypeError):
+
+
+def register():
+    """sign up a new user with authy and the chat service,
+    returns the new username"""
     try:
         # get current users to check for duplicate username
-        identities = client.chat.services(chat_service_sid).users.list()
+        identities = twilio_client().chat.services(chat_service_sid).users.list()
         # create new user
         spinner.warn("new user")
 
@@ -75,7 +133,7 @@ except (KeyError, TypeError):
             spinner.warn("phone number is required for registration")
             phone = input("enter phone number (without country code): ").strip()
 
-        user = authy_api.users.create(
+        user = authy_client().users.create(
             email=email,
             phone=phone,
             country_code=int(country_code))
@@ -90,7 +148,7 @@ except (KeyError, TypeError):
             sys.exit()
 
         authy_id = config['user']['authy_id']
-        sms = authy_api.users.request_sms(authy_id)
+        sms = authy_client().users.request_sms(authy_id)
 
         if sms.ok():
             spinner.succeed(f"sms token sent to {country_code}{phone}")
@@ -103,7 +161,7 @@ except (KeyError, TypeError):
             spinner.warn("sms token is required for registration")
             token = input("enter received sms token: ").strip()
 
-        verification = authy_api.tokens.verify(authy_id, token=token)
+        verification = authy_client().tokens.verify(authy_id, token=token)
 
         if verification.ok():
             spinner.succeed("sms token verified")
@@ -122,7 +180,7 @@ except (KeyError, TypeError):
                 identity = input(
                     "enter a different username: ").strip()
         spinner.start("creating new user ...")
-        user = client.chat.services(chat_service_sid).users.create(
+        user = twilio_client().chat.services(chat_service_sid).users.create(
             identity=identity, friendly_name=identity)
         config['user']['identity'] = identity
         config['user']['friendly_name'] = identity
@@ -139,13 +197,13 @@ except (KeyError, TypeError):
 
     # add user to general channel
     try:
-        client.chat.services(chat_service_sid).channels(
+        twilio_client().chat.services(chat_service_sid).channels(
             'general').members.create(identity=identity)
         spinner.succeed(f"user added to #general")
     except TwilioRestException as err:
         if err.status == 404:
             # if !general channel, create it and add the user
-            gen_chan = client.chat.services(chat_service_sid).channels.create(
+            gen_chan = twilio_client().chat.services(chat_service_sid).channels.create(
                 friendly_name='General Chat Channel',
                 unique_name='general',
                 created_by=identity
@@ -154,29 +212,93 @@ except (KeyError, TypeError):
             config['channels']['general'] = gen_chan.sid
             with open('.cchat.cfg', 'w+') as configfile:
                 config.write(configfile)
-            client.chat.services(chat_service_sid).channels(
+            twilio_client().chat.services(chat_service_sid).channels(
                 'general').members.create(identity=identity)
             spinner.succeed(f"user added to #general")
         else:
             spinner.fail(err.msg)
             sys.exit()
 
+    return identity
 
-def get_channels():
-    """get channels that the logged in user is a member of"""
-    channels_list = []
 
-    # fetch service channels
-    channels = client.chat.services(chat_service_sid).channels.list()
-    gen = None
-    for channel in channels:
-        channels_list.append((
-            channel.sid,
-            channel.unique_name,
-        ))
+class ChannelDirectory:
+    """Cache of the service channels, looked up by sid or by unique name.
 
-        if not gen and channel.unique_name == 'general':
-            gen = channel.sid
+    The channel list is fetched again once it is older than `ttl` seconds,
+    or after invalidate() when a channel has been added or deleted.
+    name() and sid() only read the cache so they are safe to call from
+    the webhook path; a stale cache is refreshed in the background.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.by_sid = {}
+        self.by_name = {}
+        self._fetched_at = None
+        self._refreshing = threading.Lock()
+
+    @property
+    def stale(self):
+        return self._fetched_at is None or \
+            time.monotonic() - self._fetched_at > self.ttl
+
+    def refresh(self):
+        """fetch service channels"""
+        with metrics.twilio_call('list_channels'):
+            channels = twilio_client().chat.services(chat_service_sid) \
+                .channels.list()
+        by_sid = {channel.sid: channel.unique_name for channel in channels}
+        self.by_sid = by_sid
+        self.by_name = {name: sid for sid, name in by_sid.items()}
+        self._fetched_at = time.monotonic()
+
+    def refresh_in_background(self):
+        if not self._refreshing.acquire(blocking=False):
+            return  # already refreshing
+
+        def refresh():
+            try:
+                self.refresh()
+            except Exception:
+                pass  # keep serving the old list, retried on next lookup
+            finally:
+                self._refreshing.release()
+
+        threading.Thread(name='channel_refresh', target=refresh,
+                         daemon=True).start()
+
+    def invalidate(self):
+        self._fetched_at = None
+
+    def channels(self):
+        """(sid, unique_name) pairs, fetched from the api if stale"""
+        if self.stale:
+            # wait for a background refresh that's already running
+            with self._refreshing:
+                if self.stale:
+                    self.refresh()
+        return list(self.by_sid.items())
+
+    def name(self, sid):
+        if self.stale:
+            self.refresh_in_background()
+        return self.by_sid.get(sid)
+
+    def sid(self, name):
+        if self.stale:
+            self.refresh_in_background()
+        return self.by_name.get(name)
+
+
+channel_directory = ChannelDirectory(
+    ttl=config.getint('cache', 'channels_ttl', fallback=300))
+
+
+def get_channels():
+    """get channels that the logged in user is a member of"""
+    channels_list = channel_directory.channels()
+    gen = channel_directory.by_name.get('general')
 
     # add general to config if it doesn't exist
     try:
@@ -195,10 +317,14 @@ def get_channels():
     return channels_list
 
 
+# keeps connections to the chat api open between messages
+session = requests.Session()
+
+
 def send_message(channel, message):
     # creating a message with the client won't trigger a webhook
     # so do a direct POST request to the api
-    url = f"https://chat.twilio.com/v2/Services/{chat_service_sid}/Channels/" \
+    url = f"{chat_url}/v2/Services/{chat_service_sid}/Channels/" \
           f"{channel}/Messages"
     data = {
         "From": identity,
@@ -208,13 +334,18 @@ def send_message(channel, message):
         'X-Twilio-Webhook-Enabled': 'true',
         'Content-Type': 'application/x-www-form-urlencoded'
     }
-    requests.post(url, data, headers=headers,
-                  auth=(account_sid, auth_token))
+    with metrics.twilio_call('send_message'):
+        response = session.post(url, data, headers=headers,
+                                auth=(account_sid, auth_token), timeout=10)
+        response.raise_for_status()
 
 
 # handle commands
 
-def command_handler(cmd_string):
+def command_handler(cmd_string, report=print, history=None, on_backfill=None):
+    """`report` shows output of commands that keep running in the
+    background, `history` is the HistoryStore searched by /search and
+    filled by /backfill, which passes new messages to `on_backfill`"""
     help_text = """
     cchat commands
     """
@@ -239,22 +370,45 @@ def command_handler(cmd_string):
     elif cmd_string.startswith('/sms '):
         args = cmd_string.split(None, 2)
         if len(cmd_string.split()) < 3:
-            return "Error: MOBILE_NUMBER and MESSAGE arguments are required"
-        return send_sms(args[1], args[2])
-    elif cmd_string.startswith('/cleanup '):
+            return "Error: MOBILE_NUMBER[,...] or @GROUP and MESSAGE " \
+                   "arguments are required"
+        return send_sms(args[1], args[2], report)
+    elif cmd_string.split()[0] == '/cleanup':
+        args = cmd_string.split()
+        if len(args) > 2 or (len(args) == 2 and args[1] != 'cancel'):
+            return "Error: usage /cleanup [cancel]"
+        if len(args) == 2:
+            return cancel_cleanup()
+        return cleanup(report)
+    elif cmd_string.split()[0] == '/search':
+        args = cmd_string.split(None, 1)
+        if len(args) < 2:
+            return "Error: usage /search [#CHANNEL] TERMS or /search more"
+        return search(history, args[1])
+    elif cmd_string.split()[0] == '/backfill':
         if len(cmd_string.split()) > 1:
-            return "Error: too many arguments supplied for command"
-        return cleanup()
+            return "Error: usage /backfill"
+        return backfill(history, report, on_backfill)
+    elif cmd_string.split()[0] == '/profile':
+        args = cmd_string.split()
+        if len(args) > 1 and args[1] == 'start' and len(args) <= 3:
+            return metrics.start_profile(*args[2:])
+        elif len(args) > 1 and args[1] == 'stop' and len(args) <= 3:
+            return metrics.stop_profile(*args[2:])
+        return "Error: usage /profile start [cprofile|sample] | " \
+               "/profile stop [FILE]"
     else:
         return "Error: invalid command"
 
 
 def add_channel(name):
     try:
-        client.chat.services(chat_service_sid).channels.create(
-            unique_name=name, created_by=identity)
-        client.chat.services(chat_service_sid).channels(name).members.create(
-            identity=identity)
+        with metrics.twilio_call('add_channel'):
+            twilio_client().chat.services(chat_service_sid).channels.create(
+                unique_name=name, created_by=identity)
+            twilio_client().chat.services(chat_service_sid).channels(name).members.create(
+                identity=identity)
+        channel_directory.invalidate()
         return f"{ansi_italics}{ansi_bold}#{name} created{ansi_end}"
     except TwilioRestException as e:
         return f"{ansi_red}{e.msg}{ansi_end}"
@@ -262,27 +416,176 @@ def add_channel(name):
 
 def delete_channel(name):
     try:
-        client.chat.services(chat_service_sid).channels(name).delete()
+        with metrics.twilio_call('delete_channel'):
+            twilio_client().chat.services(chat_service_sid).channels(name).delete()
+        channel_directory.invalidate()
         return f"{ansi_italics}{ansi_bold}#{name} deleted{ansi_end}"
     except TwilioRestException as e:
         return f"{ansi_red}{e.msg}{ansi_end}"
 
 
-def send_sms(number, sms):
+def sms_recipients(recipients):
+    """numbers from a comma separated list of numbers and @groups, the
+    groups being listed in the [sms_groups] section of the config"""
+    numbers = []
+    for recipient in recipients.split(','):
+        recipient = recipient.strip()
+        if recipient.startswith('@'):
+            group = config.get('sms_groups', recipient[1:], fallback=None)
+            if group is None:
+                raise KeyError(recipient)
+            numbers += re.split(r'[\s,]+', group.strip())
+        elif recipient:
+            numbers.append(recipient)
+    return list(dict.fromkeys(numbers))  # without repeats, in order
+
+
+def send_sms(recipients, sms, report=print):
+    """send an sms to each recipient in the background, see sms_recipients"""
     try:
-        client.messages.create(
-            body=sms, messaging_service_sid=sms_service_sid, to=number)
-        return f"{ansi_italics}{ansi_bold}sms sent to {number}{ansi_end}"
-    except TwilioRestException as e:
-        return f"{ansi_red}{e.msg}{ansi_end}"
-
-
-def cleanup():
-    users = client.chat.services(chat_service_sid).users.list()
-    for u in users:
-        if u.identity != 'admin':
-            client.chat.services(chat_service_sid).users(u.sid).delete()
-    channels = client.chat.services(chat_service_sid).channels.list()
-    for ch in channels:
-        client.chat.services(chat_service_sid).channels(ch.sid).delete()
-    return "cleanup done"
+        numbers = sms_recipients(recipients)
+    except KeyError as e:
+        return f"Error: no sms group {e.args[0]} in [sms_groups]"
+    if not numbers:
+        return "Error: no numbers to send to"
+
+    def send(number):
+        with metrics.twilio_call('send_sms'):
+            twilio_client().messages.create(
+                body=sms, messaging_service_sid=sms_service_sid, to=number)
+
+    BulkJob(
+        'sms', send, numbers,
+        workers=config.getint('sms', 'workers', fallback=4),
+        rate=config.getfloat('sms', 'rate', fallback=5),
+        report=lambda text: report(f"{ansi_italics}{text}{ansi_end}"),
+        report_each=True,
+    ).start()
+    return f"{ansi_italics}{ansi_bold}sending sms to {len(numbers)} " \
+           f"number{'s' if len(numbers) > 1 else ''} ...{ansi_end}"
+
+
+def message_pages(channel, page_size=100):
+    """a channel's messages from the api a page at a time, newest first"""
+    messages = twilio_client().chat.services(chat_service_sid) \
+        .channels(channel).messages
+    with metrics.twilio_call('list_messages'):
+        page = messages.page(order='desc', page_size=page_size)
+    while page is not None:
+        yield list(page)
+        with metrics.twilio_call('list_messages'):
+            page = page.next_page()
+
+
+backfill_job = None
+
+
+def backfill(history, report=print, on_messages=None):
+    """fetch the messages missed since the last run into history in the
+    background"""
+    global backfill_job
+    from backfill import Backfill
+
+    if backfill_job is not None and backfill_job.running:
+        return "Error: backfill is already running"
+    backfill_job = Backfill(
+        history, message_pages,
+        [sid for sid, _ in get_channels()],
+        describe=lambda sid: f"#{channel_directory.name(sid) or sid}",
+        workers=config.getint('backfill', 'workers', fallback=4),
+        rate=config.getfloat('backfill', 'rate', fallback=10),
+        page_size=config.getint('backfill', 'page_size', fallback=100),
+        max_messages=config.getint('backfill', 'max_messages',
+                                   fallback=1000),
+        report=report,
+        on_messages=on_messages,
+    )
+    backfill_job.start()
+    return f"{ansi_italics}fetching missed messages ...{ansi_end}"
+
+
+last_search = None
+
+
+def search(history, query):
+    """ranked full-text search of the chat history, a page at a time"""
+    global last_search
+    from message import render
+
+    page_size = config.getint('search', 'page_size', fallback=10)
+    if query.strip() == 'more':
+        if last_search is None:
+            return "Error: no search to continue"
+        terms, channel, page = last_search
+        page += 1
+    else:
+        terms, channel, page = query, None, 0
+        if terms.startswith('#'):
+            name, _, terms = terms.partition(' ')
+            channel = channel_directory.sid(name[1:])
+            if channel is None:
+                return f"Error: unknown channel {name}"
+        if not terms.strip():
+            return "Error: nothing to search for"
+    last_search = terms, channel, page
+
+    total, messages = history.search(terms, channel, page_size,
+                                      page * page_size)
+    if not total:
+        return f"{ansi_italics}no results for '{terms}'{ansi_end}"
+    first = page * page_size + 1
+    lines = [f"{ansi_italics}results {first}-{first + len(messages) - 1} "
+             f"of {total} for '{terms}'{ansi_end}"]
+    for message in messages:
+        name = channel_directory.name(message.channel) or message.channel
+        day = time.strftime('%Y-%m-%d', time.gmtime(message.created))
+        lines.append(f"#{name} {day} {render(message)}")
+    if first + len(messages) - 1 < total:
+        lines.append(f"{ansi_italics}/search more for the next "
+                     f"page{ansi_end}")
+    return '\n'.join(lines)
+
+
+cleanup_job = None
+
+
+def cleanup(report=print):
+    """delete all users (except admin) and channels in the background"""
+    global cleanup_job
+    if cleanup_job is not None and cleanup_job.running:
+        return "Error: cleanup is already running"
+
+    def entities():
+        service = twilio_client().chat.services(chat_service_sid)
+        for u in service.users.list():
+            if u.identity != 'admin':
+                yield 'user', u.sid, u.identity
+        for ch in service.channels.list():
+            yield 'channel', ch.sid, ch.unique_name
+
+    def delete(entity):
+        kind, sid, _ = entity
+        service = twilio_client().chat.services(chat_service_sid)
+        with metrics.twilio_call(f'delete_{kind}'):
+            if kind == 'user':
+                service.users(sid).delete()
+            else:
+                service.channels(sid).delete()
+
+    cleanup_job = BulkJob(
+        'cleanup', delete, entities(),
+        describe=lambda entity: f"{entity[0]} {entity[2]}",
+        workers=config.getint('cleanup', 'workers', fallback=8),
+        rate=config.getfloat('cleanup', 'rate', fallback=20),
+        report=report,
+    )
+    cleanup_job.start()
+    channel_directory.invalidate()
+    return f"{ansi_italics}cleanup started, /cleanup cancel to stop it{ansi_end}"
+
+
+def cancel_cleanup():
+    if cleanup_job is None or not cleanup_job.running:
+        return "Error: cleanup is not running"
+    cleanup_job.cancel()
+    return f"{ansi_italics}cancelling cleanup ...{ansi_end}"
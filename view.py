@@ -0,0 +1,134 @@
+"""model behind the output pane"""
+
+from collections import deque
+
+from prompt_toolkit.document import Document
+
+
+class MessageView:
+    """Line-oriented, bounded model of the output buffer.
+
+    Entries are (key, text) pairs kept in a ring buffer of at most
+    `scrollback` entries, so appending a message costs the same no matter
+    how long the session has been running. `key` is the (int) history id
+    of a stored message, a string for local lines that are updated later,
+    like a message that is still being sent, or None for local output.
+
+    Scrolling back past the oldest entry pages older messages in from
+    history through `loader(before_id, limit)`, which returns (id, text)
+    pairs oldest first. `before_id=None` asks for the newest page.
+
+    With `deferred=True` changes only reach the buffer, and so the screen,
+    when flush() is called, letting a burst of messages be drawn at once.
+    """
+
+    def __init__(self, buffer, scrollback=1000, page_size=50, loader=None,
+                 deferred=False):
+        self.buffer = buffer
+        self.page_size = page_size
+        self.loader = loader
+        self.deferred = deferred
+        self.entries = deque(maxlen=scrollback)
+        self._dirty = False
+        self._cursor_position = None
+        # set once paging back has pushed the newest entries out of the
+        # ring buffer, the view is then no longer following new messages
+        self.detached = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def oldest_key(self):
+        for key, _ in self.entries:
+            if isinstance(key, int):
+                return key
+        return None
+
+    @property
+    def has_local(self):
+        """True if a line shown isn't a stored message, like command output
+        or a message being sent, which reloading from history would lose"""
+        return any(not isinstance(key, int) for key, _ in self.entries)
+
+    def append(self, text, key=None):
+        if self.detached:
+            if isinstance(key, int):
+                # stored already, it shows up once we're back at the bottom
+                return
+            self.page_newer()
+        self.entries.append((key, text.rstrip('\n')))
+        self._sync()
+
+    def extend(self, rows):
+        """append (key, text) pairs in one go"""
+        self.entries.extend((key, text.rstrip('\n')) for key, text in rows)
+        self._sync()
+
+    def replace(self, key, text):
+        """change the line with `key`, returns False if it isn't shown"""
+        for i, (entry_key, _) in enumerate(self.entries):
+            if entry_key == key:
+                self.entries[i] = (key, text.rstrip('\n'))
+                self._sync()
+                return True
+        return False
+
+    def remove(self, key):
+        """remove the line with `key`, returns False if it isn't shown"""
+        for i, (entry_key, _) in enumerate(self.entries):
+            if entry_key == key:
+                del self.entries[i]
+                self._sync()
+                return True
+        return False
+
+    def clear(self):
+        self.entries.clear()
+        self.detached = False
+        self._sync()
+
+    def page_older(self):
+        """prepend the page of history before the oldest entry shown"""
+        if self.loader is None:
+            return False
+        rows = self.loader(self.oldest_key, self.page_size)
+        if not rows:
+            return False
+        for key, text in reversed(rows):
+            if len(self.entries) == self.entries.maxlen:
+                self.detached = True
+            self.entries.appendleft((key, text.rstrip('\n')))
+        self._sync(cursor_position=0)
+        return True
+
+    def page_newer(self):
+        """go back to the newest messages"""
+        if self.detached:
+            self.entries.clear()
+            self.detached = False
+            if self.loader is not None:
+                self.entries.extend(
+                    (key, text.rstrip('\n'))
+                    for key, text in self.loader(None, self.page_size))
+        self._sync()
+
+    def _sync(self, cursor_position=None):
+        self._dirty = True
+        self._cursor_position = cursor_position
+        if not self.deferred:
+            self.flush()
+
+    def flush(self):
+        """update the buffer if anything changed, returns True if it did"""
+        if not self._dirty:
+            return False
+        self._dirty = False
+        text = '\n'.join(text for _, text in self.entries)
+        cursor_position = self._cursor_position
+        if cursor_position is None:
+            cursor_position = len(text)
+        self.buffer.document = Document(
+            text=text, cursor_position=cursor_position,
+        )
+        return True